@@ -3,8 +3,14 @@ import numpy as np
 import numpy.random as npr
 import pandas as pd
 from datetime import datetime
+from time import time
+import os
 import os.path as osp
+import hashlib
 import itertools
+import cPickle as pickle
+from collections import defaultdict
+from multiprocessing import Pool, cpu_count
 from pprint import pprint
 
 import matplotlib.pyplot as plt
@@ -13,15 +19,91 @@ sb.set()
 
 from sklearn.model_selection import StratifiedKFold
 from sklearn.metrics import confusion_matrix
+from sklearn.base import clone
+from sklearn.pipeline import Pipeline
+from sklearn.feature_extraction.text import CountVectorizer
+
+from feature_cache import FeatureCache
 from sklearn.externals import joblib
 
+class LazyColumns(dict):
+    """ Dict of column arrays that hands out lists, built on first access, like uncached data does.
+
+    `.array(key)` gives the (memory-mapped where possible) array without building a list.
+    """
+    def __init__(self, columns):
+        dict.__init__(self, columns)
+        self.lists = {}
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if not isinstance(value, np.ndarray):
+            return value
+        if key not in self.lists:
+            self.lists[key] = value.tolist()
+        return self.lists[key]
+
+    def array(self, key):
+        return dict.__getitem__(self, key)
+
+def baseline_data_sources(train_regime, test_regime, data_path):
+    """ The files `read_baseline_data` reads for these regimes. """
+    sources = ['fixed_biased.csv', 'fixed_unbiased.csv']
+    if train_regime == 'gold':
+        sources.append('historical_unbiased.xlsx')
+    if test_regime == 'gold':
+        sources.append('fixed_current_nonbiased.xlsx')
+    return [osp.join(data_path, source) for source in sources]
+
 def setup_baseline_data(train_regime='gold',
                         test_regime='gold',
                         data_path='../data',
                         random_seed=0,
                         silver_size=10000,
-                        test_split_date='1/1/2017'):
-    """ Read in the cleaned data, split it up and format for evaluation. """
+                        test_split_date='1/1/2017',
+                        cache_dir=None):
+    """ Read in the cleaned data, split it up and format for evaluation.
+
+    With a `cache_dir` the split is saved there after the first read, keyed on the contents of the
+    source files and the split params, and later calls load it memory-mapped instead of re-parsing
+    the csv/excel files. The cached train_data/test_data are `LazyColumns`.
+    """
+    if cache_dir is None:
+        return read_baseline_data(train_regime, test_regime, data_path, random_seed, silver_size, test_split_date)
+
+    md5 = hashlib.md5()
+    md5.update(repr((train_regime, test_regime, random_seed, silver_size, test_split_date)))
+    for source in baseline_data_sources(train_regime, test_regime, data_path):
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), ''):
+                md5.update(chunk)
+    fname = osp.join(cache_dir, 'baseline_data_{}.pkl'.format(md5.hexdigest()))
+    if osp.exists(fname):
+        cached = joblib.load(fname, mmap_mode='r')
+    else:
+        data = read_baseline_data(train_regime, test_regime, data_path, random_seed, silver_size, test_split_date)
+        cached = {'all_B_over_U':data['all_B_over_U']}
+        for split in ['train_data', 'test_data']:
+            cached[split] = {
+                'text':np.array(data[split]['text'], dtype=object),
+                'is_foodborne':np.array(data[split]['is_foodborne']),
+                'is_multiple':np.array(data[split]['is_multiple']),
+                'is_biased':np.array(data[split]['is_biased'], dtype=bool)
+            }
+        cached['test_data']['all_B_over_U'] = data['all_B_over_U']
+        if not osp.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+        joblib.dump(cached, tmp_fname)
+        os.rename(tmp_fname, fname)
+    return {
+        'train_data':LazyColumns(cached['train_data']),
+        'test_data':LazyColumns(cached['test_data']),
+        'all_B_over_U':cached['all_B_over_U']
+    }
+
+def read_baseline_data(train_regime, test_regime, data_path, random_seed, silver_size, test_split_date):
+    """ Read the cleaned data from the csv/excel files and split it up. """
     test_split_date = datetime.strptime(test_split_date, '%m/%d/%Y')
     biased = pd.read_csv(osp.join(data_path, 'fixed_biased.csv'), encoding='utf8')
     biased.date = pd.to_datetime(biased.date)
@@ -94,11 +176,12 @@ def setup_baseline_data(train_regime='gold',
 
 def calc_importance_weights(is_biased, all_B_over_U):
     """ Get the IW for bias-corrected error rate. """
-    B = float(sum(is_biased))
+    is_biased = np.asarray(is_biased, dtype=bool)
+    B = float(is_biased.sum())
     B_c = len(is_biased) - B + 1e-15 # for stability when all are biased
     w_B = ((B + B_c)/B) * all_B_over_U#1./U
     w_Bc = ((B + B_c)/B_c) * (1- all_B_over_U)#(1.-(B/U))*(1./Bc)
-    iw = np.array([w_B if label else w_Bc for label in is_biased])
+    iw = np.where(is_biased, w_B, w_Bc)
     #rescaled = (len(is_biased)/iw.sum())*iw
     return iw
 
@@ -127,72 +210,318 @@ def importance_weighted_precision_recall(y_trues, y_pred_probs, iws, threshold=.
     #    print '{t} ; {prate:0.2f}, {Up} : {rrate:0.2f}, {Ur}:: '.format(t=threshold, prate=p_bias_rate, rrate=r_bias_rate, Up=Up, Ur=Ur)
     return precision, recall
 
+def importance_weighted_precision_recall_at(y_trues, y_pred_probs, iws, thresholds):
+    """ Bias-corrected precision and recall at many thresholds at once.
+
+    Same numbers as `importance_weighted_precision_recall` at each threshold, but the scores are
+    sorted once and the IW (true) positives accumulated, so each threshold is a binary search.
+    """
+    y_trues = np.asarray(y_trues)
+    y_pred_probs = np.asarray(y_pred_probs)
+    iws = np.asarray(iws, dtype=np.float64)
+    thresholds = np.asarray(thresholds)
+    order = np.argsort(y_pred_probs, kind='mergesort')
+    sorted_probs = y_pred_probs[order]
+    is_true = y_trues == 1
+    # weight of the top k scores, for k = 0..n
+    top_weights = np.hstack([0., np.cumsum(iws[order][::-1])])
+    top_true_weights = np.hstack([0., np.cumsum((iws * is_true)[order][::-1])])
+    Up = len(sorted_probs) - np.searchsorted(sorted_probs, thresholds, side='left')
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if y_trues.sum(): # no positive classifications when there are some it should've caught is 0 precision
+            no_positives_precision = 0.
+        else:
+            no_positives_precision = 1.
+        precisions = np.where(Up > 0, top_true_weights[Up] / top_weights[Up], no_positives_precision)
+        if is_true.any():
+            recalls = top_true_weights[Up] / iws[is_true].sum()
+            # exactly 1 once every positive is predicted, whatever the summation order, since the curve stops there
+            recalls[thresholds <= y_pred_probs[is_true].min()] = 1.
+        else:
+            recalls = np.ones(len(thresholds))
+    return precisions, recalls
+
 def importance_weighted_pr_curve(y_trues, y_pred_probs, iws, n_thresholds=100):
-    """ Calculate a whole bias-corrected PR-curve. """
-    thresholds = np.linspace(np.max(y_pred_probs), 0, n_thresholds)
-    precisions, recalls = [], []
-    for t in thresholds:
-        p, r = importance_weighted_precision_recall(y_trues, y_pred_probs, iws, t)
-        precisions.append(p)
-        recalls.append(r)
-        if r >= 1.:
-            break
-    return np.array(precisions), np.array(recalls), thresholds[:len(precisions)]
+    """ Calculate a whole bias-corrected PR-curve.
+
+    The curve stops at the first threshold with full recall. With `n_thresholds=None` every unique
+    score is a threshold, which gives the exact curve.
+    """
+    if n_thresholds is None:
+        thresholds = np.unique(y_pred_probs)[::-1]
+    else:
+        thresholds = np.linspace(np.max(y_pred_probs), 0, n_thresholds)
+    precisions, recalls = importance_weighted_precision_recall_at(y_trues, y_pred_probs, iws, thresholds)
+    full_recall = np.flatnonzero(recalls >= 1.)
+    n = full_recall[0] + 1 if len(full_recall) else len(thresholds)
+    return precisions[:n], recalls[:n], thresholds[:n]
 
 def area_under_pr_curve(precisions, recalls):
     """ Calculate area under curve using trapezoidal integration. """
-    aupr = 0.
-    for i in range(len(precisions)-1):
-        aupr += .5 * (recalls[i+1] - recalls[i]) * (precisions[i] + precisions[i+1])
-    return aupr
+    precisions = np.asarray(precisions, dtype=np.float64)
+    recalls = np.asarray(recalls, dtype=np.float64)
+    return float(np.sum(.5 * np.diff(recalls) * (precisions[:-1] + precisions[1:])))
 
-def score_model(model, xs, ys, bs, all_B_over_U, fit_weight_kwd, n_cv_splits, random_seed):
-    """ For dev tuning, take a model and score using cross-validation. """
+def compact_data(xs, ys, bs):
+    """ Texts as an object array, labels as int8 and bias flags as bool, so folds can index them directly.
+
+    Already converted arrays are returned as they are, so this is free to call per fold.
+    """
+    return np.asarray(xs, dtype=object), np.asarray(ys, dtype=np.int8), np.asarray(bs, dtype=bool)
+
+def cv_folds(ys, bs, n_cv_splits, random_seed):
+    """ The (train_idx, dev_idx) splits used for dev tuning, stratified on label and bias. """
     folds = StratifiedKFold(n_splits=n_cv_splits, random_state=random_seed)
     stratify_on_these = ['{},{}'.format(y,b) for y,b in zip(ys, bs)]
+    return list(folds.split(np.zeros(len(ys)), stratify_on_these))
+
+def score_fold(model, xs, ys, bs, all_B_over_U, fit_weight_kwd, train_idx, dev_idx, feature_cache=None):
+    """ Fit the model on one cv fold and return its IW-F1 on the held out part.
+
+    With a `feature_cache` the first (count) step is taken from the cache and only the rest of the
+    pipeline is fit, which leaves `model` itself unfit. Pipelines that do not start with a
+    CountVectorizer (e.g. `hash_model`) have nothing to cache and are always fit whole.
+    """
+    xs, ys, bs = compact_data(xs, ys, bs)
+    train_ys = ys[train_idx]
+    train_is_biased = bs[train_idx]
+
+    dev_ys = ys[dev_idx]
+    dev_is_biased = bs[dev_idx]
+
+    train_importance_weights = calc_importance_weights(train_is_biased, all_B_over_U)
+    if feature_cache is not None and isinstance(model.steps[0][1], CountVectorizer):
+        train_counts, dev_counts = feature_cache.counts(model.steps[0][1], xs, train_idx, dev_idx)
+        rest = Pipeline(model.steps[1:])
+        rest.fit(train_counts, train_ys, **{fit_weight_kwd:train_importance_weights})
+        scored_devs = rest.predict_proba(dev_counts)[:,1]
+    else:
+        model.fit(xs[train_idx], train_ys, **{fit_weight_kwd:train_importance_weights})
+        scored_devs = model.predict_proba(xs[dev_idx])[:,1]
+    dev_importance_weights = calc_importance_weights(dev_is_biased, all_B_over_U)
+    dev_precision, dev_recall = importance_weighted_precision_recall(dev_ys, scored_devs, dev_importance_weights, threshold=.5)
+    # dev_precisions, dev_recalls, _ = importance_weighted_pr_curve(dev_ys, scored_devs, importance_weights)
+    # dev_aupr = area_under_pr_curve(dev_precisions, dev_recalls)
+    return f1(dev_precision, dev_recall)
+
+def score_model(model, xs, ys, bs, all_B_over_U, fit_weight_kwd, n_cv_splits, random_seed, feature_cache=None):
+    """ For dev tuning, take a model and score using cross-validation. """
+    xs, ys, bs = compact_data(xs, ys, bs)
     dev_scores = []
-    for train_idx, dev_idx in folds.split(np.zeros(len(xs)), stratify_on_these):
-
-        train_text = np.array(xs)[train_idx]
-        train_ys = np.array(ys)[train_idx]
-        train_is_biased = np.array(bs)[train_idx]
-
-        dev_text = np.array(xs)[dev_idx]
-        dev_ys = np.array(ys)[dev_idx]
-        dev_is_biased = np.array(bs)[dev_idx]
-
-        train_importance_weights = calc_importance_weights(train_is_biased, all_B_over_U)
-        model.fit(train_text, train_ys, **{fit_weight_kwd:train_importance_weights})
-        scored_devs = model.predict_proba(dev_text)[:,1]
-        dev_importance_weights = calc_importance_weights(dev_is_biased, all_B_over_U)
-        dev_precision, dev_recall = importance_weighted_precision_recall(dev_ys, scored_devs, dev_importance_weights, threshold=.5)
-        dev_f1 = f1(dev_precision, dev_recall)
-        # dev_precisions, dev_recalls, _ = importance_weighted_pr_curve(dev_ys, scored_devs, importance_weights)
-        # dev_aupr = area_under_pr_curve(dev_precisions, dev_recalls)
-        dev_scores.append(dev_f1)
+    for train_idx, dev_idx in cv_folds(ys, bs, n_cv_splits, random_seed):
+        dev_scores.append(score_fold(model, xs, ys, bs, all_B_over_U, fit_weight_kwd, train_idx, dev_idx,
+                                     feature_cache=feature_cache))
     return np.array(dev_scores)
 
-def random_search(model, random_hyperparams, model_fname, **score_kwds):
-    """ Perform a random search experiment for some model on a random grid and write to a file. """
-    experiments = []
+def partial_fit_model(model, batches, classes):
+    """ Train a pipeline out-of-core, one batch at a time, with its last step's `partial_fit`.
+
+    Every step before the last must be stateless (like the HashingVectorizer in `hash_model`), since they
+    are only used to transform. `batches` yields (xs, ys) or (xs, ys, sample_weights), so only one batch
+    needs to be in memory, and `classes` must list every label up front.
+    """
+    classifier = model.steps[-1][1]
+    for batch in batches:
+        xs, ys = batch[0], batch[1]
+        for name, transform in model.steps[:-1]:
+            xs = transform.transform(xs)
+        fit_kwds = {'sample_weight':batch[2]} if len(batch) > 2 else {}
+        classifier.partial_fit(xs, ys, classes=classes, **fit_kwds)
+    return model
+
+def model_footprint(model, model_fname, xs):
+    """ Size on disk of a dumped model and how many docs/sec it scores, to compare model types. """
+    t0 = time()
+    model.predict_proba(xs)
+    return {'model_mb':osp.getsize(model_fname) / 2.**20,
+            'docs_per_sec':len(xs) / (time() - t0)}
+
+def read_search_log(log_fname):
+    """ Read the experiments appended to a random search log, and the offset where the last complete one ends. """
+    experiments, offset = [], 0
+    if log_fname and osp.exists(log_fname):
+        with open(log_fname, 'rb') as f:
+            while True:
+                try:
+                    experiments.append(pickle.load(f))
+                except (EOFError, ValueError, pickle.UnpicklingError):
+                    break # a run that died mid-write leaves a truncated record at the end
+                offset = f.tell()
+    return experiments, offset
+
+def _check_search_log(records, log_fname, key, search):
+    """ Fail clearly on a log written by the other kind of search, whose records have other fields. """
+    for record in records:
+        if key not in record:
+            raise ValueError, "{} was not written by {}; give this search its own log_fname".format(log_fname, search)
+
+# state for the random search worker processes, set once per process by the pool initializer
+_search_state = {}
+
+def _init_search_worker(model, score_kwds):
+    _search_state['model'] = model
+    _search_state['score_kwds'] = score_kwds
+
+def _score_search_task(task):
+    i, params, fold, (train_idx, dev_idx) = task
+    kwds = _search_state['score_kwds']
+    model = clone(_search_state['model']).set_params(**params)
+    return i, fold, score_fold(model, kwds['xs'], kwds['ys'], kwds['bs'], kwds['all_B_over_U'],
+                               kwds['fit_weight_kwd'], train_idx, dev_idx,
+                               feature_cache=kwds.get('feature_cache'))
+
+def _start_search(model, score_kwds, n_jobs):
+    """ The worker pool (None when serial) and a function that scores (config, fold) tasks on it. """
+    if n_jobs == 1:
+        _init_search_worker(model, score_kwds)
+        return None, lambda tasks: itertools.imap(_score_search_task, tasks)
+    pool = Pool(n_jobs if n_jobs > 0 else cpu_count(), _init_search_worker, (model, score_kwds))
+    return pool, lambda tasks: pool.imap_unordered(_score_search_task, tasks)
+
+def _refit_best(model, params, model_fname, folds, score_kwds):
+    """ Refit a search's new best config on the last fold, dump it and return its `model_footprint`. """
+    # the workers' fitted copies are gone (and skipped the count step if cached),
+    # so refit the whole pipeline on the last fold like the serial search did
+    model.set_params(**params)
+    train_idx, dev_idx = folds[-1]
+    score_fold(model, score_kwds['xs'], score_kwds['ys'], score_kwds['bs'], score_kwds['all_B_over_U'],
+               score_kwds['fit_weight_kwd'], train_idx, dev_idx)
+    joblib.dump(model, model_fname)
+    footprint = model_footprint(model, model_fname, score_kwds['xs'][dev_idx])
+    print 'footprint: {model_mb:.1f}MB, {docs_per_sec:.0f} docs/sec'.format(**footprint)
+    return footprint
+
+def random_search(model, random_hyperparams, model_fname, n_jobs=1, log_fname=None, **score_kwds):
+    """ Perform a random search experiment for some model on a random grid and write to a file.
+
+    Every (config, fold) pair is scored as a separate task on `n_jobs` processes (-1 for all cores).
+    If `log_fname` is given, each finished config is appended to it and a rerun skips the configs
+    already there, so a crashed search picks up where it left off. Each new best also records its
+    `model_footprint`, so searches over different model types can be compared on size and speed.
+    """
     N = len(random_hyperparams.values()[0])
-    best_score = -1.0
-    best_params = {}
-    for i in range(N):
-        random_hyperparam = {k:v[i] for k,v in random_hyperparams.items()}
-        model.set_params(**random_hyperparam)
-        print '\n------- Experiment {}/{} -------'.format(i+1, N)
-        print 'params: {}'.format(random_hyperparam)
+    configs = [{k:v[i] for k,v in random_hyperparams.items()} for i in range(N)]
+    experiments, offset = read_search_log(log_fname)
+    _check_search_log(experiments, log_fname, 'scores', 'random_search')
+    for experiment in experiments:
+        if repr(experiment['random_params']) != repr(configs[experiment['i']]):
+            raise ValueError, "{} was written by a search over different hyperparams".format(log_fname)
+    done = set(experiment['i'] for experiment in experiments)
+    best_score = max([experiment['scores'].mean() for experiment in experiments] + [-1.0])
+    if done:
+        print 'Resuming from {}: {}/{} experiments done, best so far {:2.2f}'.format(log_fname, len(done), N, best_score)
+
+    # convert once here rather than per fold, and before the pool forks so every worker shares the arrays
+    score_kwds['xs'], score_kwds['ys'], score_kwds['bs'] = compact_data(score_kwds['xs'], score_kwds['ys'], score_kwds['bs'])
+    folds = cv_folds(score_kwds['ys'], score_kwds['bs'], score_kwds['n_cv_splits'], score_kwds['random_seed'])
+    tasks = [(i, configs[i], fold, split) for i in range(N) if i not in done for fold, split in enumerate(folds)]
+    pool, score_tasks = _start_search(model, score_kwds, n_jobs)
+    results = score_tasks(tasks)
+
+    log = None
+    if log_fname:
+        log = open(log_fname, 'ab')
+        log.truncate(offset)
+    fold_scores = defaultdict(dict)
+    for i, fold, score in results:
+        fold_scores[i][fold] = score
+        if len(fold_scores[i]) < len(folds):
+            continue
+        scores = fold_scores.pop(i)
+        model.set_params(**configs[i])
         experiment = {'i':i,
-                      'params':model.get_params(),
-                      'scores':score_model(model, **score_kwds)}
+                      'params':{k:v for k,v in model.get_params().items() if '__' in k},
+                      'random_params':configs[i],
+                      'scores':np.array([scores[f] for f in range(len(folds))])}
         experiments.append(experiment)
-        print 'scores: {}'.format(experiments[-1]['scores'])
-        score = experiments[-1]['scores'].mean()
+        print '\n------- Experiment {}/{} -------'.format(i+1, N)
+        print 'params: {}'.format(configs[i])
+        print 'scores: {}'.format(experiment['scores'])
+        score = experiment['scores'].mean()
         if score > best_score:
             print 'New best: {0:2.2f}'.format(score)
             best_score = score
-            joblib.dump(model, model_fname)
+            experiment['footprint'] = _refit_best(model, configs[i], model_fname, folds, score_kwds)
+        if log:
+            pickle.dump(experiment, log, pickle.HIGHEST_PROTOCOL)
+            log.flush()
+    if log:
+        log.close()
+    if pool:
+        pool.close()
+        pool.join()
+    return sorted(experiments, key=lambda x:x['i'])
+
+def successive_halving_search(model, random_hyperparams, model_fname, eta=3, n_jobs=1, log_fname=None, **score_kwds):
+    """ Like `random_search`, but drops the configs that score poorly on the first cv folds.
+
+    Rung r scores the surviving configs on the first min(eta**r, n_cv_splits) folds, reusing the
+    folds they were already scored on, and keeps the top 1/`eta` by mean IW-F1 until the survivors
+    have been scored on every fold. With 5 folds and eta=3 that is under 2 fits per config instead of 5.
+    Every scored (config, fold) is appended to `log_fname`, so a rerun only fits what is missing.
+    Its records differ from `random_search`'s, so the two cannot share a log (e.g. use `*_halving_dev.log`).
+    The returned experiments have the scores of the folds each config got to, and the rung it reached.
+    """
+    N = len(random_hyperparams.values()[0])
+    configs = [{k:v[i] for k,v in random_hyperparams.items()} for i in range(N)]
+    records, offset = read_search_log(log_fname)
+    _check_search_log(records, log_fname, 'fold', 'successive_halving_search')
+    fold_scores = defaultdict(dict)
+    for record in records:
+        if repr(record['random_params']) != repr(configs[record['i']]):
+            raise ValueError, "{} was written by a search over different hyperparams".format(log_fname)
+        fold_scores[record['i']][record['fold']] = record['score']
+    if records:
+        print 'Resuming from {}: {} folds already scored'.format(log_fname, len(records))
+
+    score_kwds['xs'], score_kwds['ys'], score_kwds['bs'] = compact_data(score_kwds['xs'], score_kwds['ys'], score_kwds['bs'])
+    folds = cv_folds(score_kwds['ys'], score_kwds['bs'], score_kwds['n_cv_splits'], score_kwds['random_seed'])
+    pool, score_tasks = _start_search(model, score_kwds, n_jobs)
+    log = None
+    if log_fname:
+        log = open(log_fname, 'ab')
+        log.truncate(offset)
+
+    survivors, rungs, rung = range(N), {}, 0
+    while True:
+        n_folds = min(eta**rung, len(folds))
+        tasks = [(i, configs[i], fold, folds[fold]) for i in survivors for fold in range(n_folds)
+                 if fold not in fold_scores[i]]
+        for i, fold, score in score_tasks(tasks):
+            fold_scores[i][fold] = score
+            if log:
+                pickle.dump({'i':i, 'fold':fold, 'score':score, 'random_params':configs[i]}, log, pickle.HIGHEST_PROTOCOL)
+                log.flush()
+        means = {i:np.mean([fold_scores[i][fold] for fold in range(n_folds)]) for i in survivors}
+        survivors = sorted(survivors, key=lambda i:(-means[i], i))
+        for i in survivors:
+            rungs[i] = rung
+        print '\n------- Rung {}: {} configs on {} folds, best {:2.2f} -------'.format(
+            rung, len(survivors), n_folds, means[survivors[0]])
+        if n_folds == len(folds):
+            break
+        survivors = survivors[:max(1, len(survivors) // eta)]
+        rung += 1
+
+    if log:
+        log.close()
+    if pool:
+        pool.close()
+        pool.join()
+
+    experiments = []
+    for i in sorted(rungs):
+        model.set_params(**configs[i])
+        experiments.append({'i':i,
+                            'params':{k:v for k,v in model.get_params().items() if '__' in k},
+                            'random_params':configs[i],
+                            'scores':np.array([fold_scores[i][fold] for fold in sorted(fold_scores[i])]),
+                            'rung':rungs[i]})
+    best = survivors[0]
+    print 'Best: {} {:2.2f}'.format(configs[best], means[best])
+    experiments[best]['footprint'] = _refit_best(model, configs[best], model_fname, folds, score_kwds)
+    print '{} fits instead of {}'.format(sum(len(scores) for scores in fold_scores.values()), N * len(folds))
     return experiments
 
 def f1(precision, recall):
@@ -200,57 +529,133 @@ def f1(precision, recall):
 
 def ci(xbar, samples, confidence_level=.95):
     """ Calculate an empirical confidence interval. """
-    diffs = [ xbar - xi for xi in samples]
+    diffs = xbar - np.asarray(samples)
     alpha = (1. - confidence_level)/2.
     ci_bottom = xbar - np.percentile(diffs, 100.*(1-alpha))
     ci_top = xbar - np.percentile(diffs, 100.*alpha)
     return ci_bottom, ci_top
 
+def iw_f1_scores(trues, preds, weights, threshold=.5):
+    """ IW-F1 at `threshold` for each row of a (replicates x examples) matrix of sample weights.
+
+    A row of importance weights times bootstrap counts scores the same as the resampled copy it stands for.
+    """
+    in_Up = preds >= threshold
+    in_Ur = trues == 1
+    tp = weights.dot(in_Up & in_Ur)
+    up = weights.dot(in_Up)
+    ur = weights.dot(in_Ur)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precisions = np.where(up > 0., tp / up, np.where(ur > 0., 0., 1.))
+        recalls = np.where(ur > 0., tp / ur, 1.)
+    return f1(precisions, recalls)
+
+def iw_aupr_scores(trues, preds, weights, n_thresholds=50):
+    """ IW-AUPR on an `n_thresholds` grid for each row of a (replicates x examples) matrix of sample weights.
+
+    Matches `importance_weighted_pr_curve` + `area_under_pr_curve` on the resampled copy each row stands for,
+    including a grid that starts at the highest score present in that copy.
+    """
+    present = weights > 0.
+    is_true = trues == 1
+    order = np.argsort(preds, kind='mergesort')
+    sorted_probs = preds[order]
+    k, n = weights.shape
+    rows = np.arange(k)[:, np.newaxis]
+    # weight of the top j scores of each row, for j = 0..n
+    top_weights = np.hstack([np.zeros((k, 1)), np.cumsum(weights[:, order[::-1]], axis=1)])
+    top_true_weights = np.hstack([np.zeros((k, 1)), np.cumsum((weights * is_true)[:, order[::-1]], axis=1)])
+
+    max_probs = np.where(present, preds, -np.inf).max(axis=1)
+    thresholds = np.array([np.linspace(max_prob, 0, n_thresholds) for max_prob in max_probs])
+    Up = n - np.searchsorted(sorted_probs, thresholds.ravel(), side='left').reshape(thresholds.shape)
+    tp = top_true_weights[rows, Up]
+    up = top_weights[rows, Up]
+    ur = top_true_weights[:, -1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precisions = np.where(up > 0., tp / up, np.where(ur > 0., 0., 1.))
+        recalls = np.where(ur > 0., tp / ur, 1.)
+    min_true_probs = np.where(present & is_true, preds, np.inf).min(axis=1)
+    recalls[thresholds <= min_true_probs[:, np.newaxis]] = 1.
+
+    # each curve stops at its first full recall threshold
+    full_recall = recalls >= 1.
+    stops = np.where(full_recall.any(axis=1), full_recall.argmax(axis=1), n_thresholds-1)
+    in_curve = np.arange(n_thresholds-1)[np.newaxis, :] < stops[:, np.newaxis]
+    areas = .5 * np.diff(recalls, axis=1) * (precisions[:, :-1] + precisions[:, 1:])
+    return (areas * in_curve).sum(axis=1)
+
+def _score_bootstrap_batch(task):
+    scoring_func, trues, preds, weights, scoring_func_kwds = task
+    return scoring_func(trues, preds, weights, **scoring_func_kwds)
+
 def iw_bootstrap_score_ci(trues, preds, is_biased, importance_weights,
                           scoring_func,
                           B=1000, confidence_level=.95,
                           random_seed=None,
+                          batch_size=100, n_jobs=1,
                           **scoring_func_kwds):
     """ Compute a bootstrapped estimate of the importance weighted model score and stratified resampling.
 
+    Resamples are never materialized: each is a row of how many times every example was drawn, and
+    `scoring_func(trues, preds, weights, **scoring_func_kwds)` scores `batch_size` rows of importance
+    weight x count at once (see `iw_f1_scores`). The draws are the same as for per-resample `npr.choice`,
+    so a given seed gives the same replicates as before. Batches can be scored on `n_jobs` processes.
+
     An intuitive and practical guide to bootstrap estimation:
     https://ocw.mit.edu/courses/mathematics/18-05-introduction-to-probability-and-statistics-spring-2014/readings/MIT18_05S14_Reading24.pdf
     """
     if random_seed: npr.seed(random_seed)
-    xbar = scoring_func(trues, preds, importance_weights, **scoring_func_kwds)
-    samples = []
+    trues = np.asarray(trues)
+    preds = np.asarray(preds)
+    is_biased = np.asarray(is_biased, dtype=bool)
+    importance_weights = np.asarray(importance_weights, dtype=np.float64)
+    xbar = scoring_func(trues, preds, importance_weights[np.newaxis, :], **scoring_func_kwds)[0]
     biased_idxs = np.argwhere(is_biased).ravel()
     nonbiased_idxs = np.argwhere(~is_biased).ravel()
+
+    def batches():
+        for start in range(0, B, batch_size):
+            counts = np.zeros((min(batch_size, B-start), len(preds)))
+            for row in counts:
+                row[biased_idxs] = np.bincount(npr.randint(0, len(biased_idxs), len(biased_idxs)),
+                                               minlength=len(biased_idxs))
+                if len(nonbiased_idxs):
+                    row[nonbiased_idxs] = np.bincount(npr.randint(0, len(nonbiased_idxs), len(nonbiased_idxs)),
+                                                      minlength=len(nonbiased_idxs))
+            counts *= importance_weights
+            yield scoring_func, trues, preds, counts, scoring_func_kwds
+
+    if n_jobs == 1:
+        pool = None
+        results = itertools.imap(_score_bootstrap_batch, batches())
+    else:
+        pool = Pool(n_jobs if n_jobs > 0 else cpu_count())
+        results = pool.imap(_score_bootstrap_batch, batches())
+    samples = []
     print
-    for i in range(B):
-        print '\rB: {}/{}'.format(i,B),
-        if len(nonbiased_idxs):
-            sample = np.hstack([npr.choice(biased_idxs, len(biased_idxs)),
-                                npr.choice(nonbiased_idxs, len(nonbiased_idxs))])
-        else:
-            sample = npr.choice(biased_idxs, len(biased_idxs))
-        samples.append(scoring_func(trues[sample], preds[sample], importance_weights[sample], **scoring_func_kwds))
+    for scores in results:
+        samples.extend(scores)
+        print '\rB: {}/{}'.format(len(samples),B),
+    if pool:
+        pool.close()
+        pool.join()
+    samples = np.array(samples)
     ci_bottom, ci_top = ci(xbar, samples, confidence_level)
     return xbar, ci_bottom, ci_top, samples
 
 def bootstrap_f1_ci(trues, preds, is_biased, importance_weights, random_seed=None, **bootstrap_kwds):
     """ Get bootstrap confidence intervals around IW-F1 score. """
-    def scorer(trues, preds, importance_weights):
-        p, r = importance_weighted_precision_recall(trues, preds, importance_weights, threshold=.5)
-        return f1(p,r)
-    return iw_bootstrap_score_ci(trues, preds, is_biased, importance_weights, scorer,
+    return iw_bootstrap_score_ci(trues, preds, is_biased, importance_weights, iw_f1_scores,
                               random_seed=random_seed,
+                              threshold=.5,
                               **bootstrap_kwds)
 
 def bootstrap_aupr_ci(trues, preds, is_biased, importance_weights, random_seed=None, **bootstrap_kwds):
     """ Get bootstrap confidence intervals around IW-AUPR score. """
-    def scorer(trues, preds, importance_weights):
-        #plt.hist(preds, bins=100, alpha=.25)
-        ps, rs, ts = importance_weighted_pr_curve(trues, preds, importance_weights, n_thresholds=50)
-        #plt.plot(rs, ps, alpha=.5)
-        return area_under_pr_curve(ps, rs)
-    return iw_bootstrap_score_ci(trues, preds, is_biased, importance_weights, scorer,
+    return iw_bootstrap_score_ci(trues, preds, is_biased, importance_weights, iw_aupr_scores,
                               random_seed=random_seed,
+                              n_thresholds=50,
                               **bootstrap_kwds)
 
 def subplot_confusion_matrix(cm, classes,
@@ -0,0 +1,184 @@
+""" Benchmark how fast the production models score text.
+
+Usage:
+    python benchmark.py                         # benchmark and compare against benchmark_baseline.json
+    python benchmark.py --save-baseline         # benchmark and store the results as the new baseline
+    python benchmark.py --synthetic-only        # skip the deployed artifacts
+
+Each deployed artifact found under `src/` is loaded and timed, as are the `hash_model`, `lr_model`,
+`rf_model` and `svm_model` pipelines fit on synthetic reviews. Every model runs in its own process so peak
+RSS is per model. Exits non-zero when docs/sec or p99 latency regress past `--tolerance`.
+"""
+import argparse
+import json
+import cPickle as pickle
+import os.path as osp
+import os
+import resource
+import sys
+import tempfile
+from multiprocessing import Pool
+from time import time
+
+import numpy as np
+import numpy.random as npr
+
+from sklearn.base import clone
+from sklearn.externals import joblib
+
+import hash_model
+import lr_model
+import rf_model
+import svm_model
+
+SRC = osp.join(osp.dirname(osp.abspath(__file__)), '..', '..', '..', 'src')
+ARTIFACTS = {
+    'final_yelp_sick_model': osp.join(SRC, 'yelp-classify', 'final_yelp_models', 'final_yelp_sick_model.gz'),
+    'final_yelp_mult_model': osp.join(SRC, 'yelp-classify', 'final_yelp_models', 'final_yelp_mult_model.gz'),
+    'best_lr_sick_silver': osp.join(SRC, 'twitter-classify', 'final_twitter_models', 'best_lr_sick_silver.pkl'),
+}
+PIPELINES = {
+    'hash_model': (hash_model.model, 'sgd__sample_weight'),
+    'lr_model': (lr_model.model, 'logreg__sample_weight'),
+    'rf_model': (rf_model.model, 'rf__sample_weight'),
+    'svm_model': (svm_model.model, 'svc__sample_weight'),
+}
+BATCH_SIZES = [1, 10, 100, 1000, 10000]
+
+WORDS = (u'the a and was we i it food place service great good bad ordered chicken pizza rice fries '
+         u'burger salad table waiter night friend dinner lunch tasty cold hot price order back never').split()
+SICK_WORDS = u'sick vomit vomiting nausea diarrhea stomach poisoning threw up ill cramps'.split()
+
+def synthetic_reviews(n, random_seed=0):
+    """ Review-like texts whose label depends on how many sick words they contain. """
+    rs = npr.RandomState(random_seed)
+    texts, labels = [], []
+    for _ in range(n):
+        length = rs.randint(20, 200)
+        n_sick = rs.binomial(3, .2)
+        words = list(rs.choice(WORDS, length)) + list(rs.choice(SICK_WORDS, n_sick))
+        rs.shuffle(words)
+        texts.append(u' '.join(words))
+        labels.append(int(n_sick > 0))
+    return np.array(texts, dtype=object), np.array(labels)
+
+def timed_load(fname):
+    t0 = time()
+    model = joblib.load(fname)
+    return model, time() - t0
+
+def load_model(name):
+    """ The model to benchmark, how long it took to load and, for a pipeline, to fit.
+
+    Pipelines are fit on synthetic reviews and then dumped and loaded back the way the services
+    load their artifacts, so `load_secs` means the same thing for both. """
+    if name in ARTIFACTS:
+        model, load_secs = timed_load(ARTIFACTS[name])
+        return model, load_secs, None
+    pipeline, fit_weight_kwd = PIPELINES[name]
+    xs, ys = synthetic_reviews(5000, random_seed=1)
+    t0 = time()
+    model = clone(pipeline).fit(xs, ys, **{fit_weight_kwd:np.ones(len(ys))})
+    fit_secs = time() - t0
+    fd, fname = tempfile.mkstemp(suffix='.pkl')
+    os.close(fd)
+    try:
+        joblib.dump(model, fname)
+        model, load_secs = timed_load(fname)
+    finally:
+        os.remove(fname)
+    return model, load_secs, fit_secs
+
+def benchmark_model(args):
+    """ Time predict_proba on each batch size; run in a child process so peak RSS is this model's. """
+    name, n_docs, repeats = args
+    model, load_secs, fit_secs = load_model(name)
+    texts, _ = synthetic_reviews(n_docs)
+    results = {'load_secs':load_secs, 'fit_secs':fit_secs,
+               'pickle_mb':len(pickle.dumps(model, pickle.HIGHEST_PROTOCOL)) / 2.**20, 'batches':{}}
+    for batch_size in BATCH_SIZES:
+        if batch_size > n_docs:
+            continue
+        latencies = []
+        n_batches = max(1, min(n_docs // batch_size, 1000))
+        for _ in range(repeats):
+            for start in range(0, n_batches * batch_size, batch_size):
+                t0 = time()
+                model.predict_proba(texts[start:start+batch_size])
+                latencies.append(time() - t0)
+        latencies = np.array(latencies)
+        results['batches'][str(batch_size)] = {
+            'docs_per_sec':batch_size * len(latencies) / latencies.sum(),
+            'p50_ms':1000. * np.percentile(latencies, 50),
+            'p99_ms':1000. * np.percentile(latencies, 99)
+        }
+    # ru_maxrss is in kilobytes on linux
+    results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    return name, results
+
+def regressions(results, baseline, tolerance):
+    """ Describe every batch size that got slower than the baseline by more than `tolerance`. """
+    found = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for batch_size, current in sorted(result['batches'].items(), key=lambda x:int(x[0])):
+            previous = baseline[name]['batches'].get(batch_size)
+            if previous is None:
+                continue
+            if current['docs_per_sec'] < (1. - tolerance) * previous['docs_per_sec']:
+                found.append('{} batch {}: {:.0f} docs/sec, baseline {:.0f}'.format(
+                    name, batch_size, current['docs_per_sec'], previous['docs_per_sec']))
+            if current['p99_ms'] > (1. + tolerance) * previous['p99_ms']:
+                found.append('{} batch {}: p99 {:.2f}ms, baseline {:.2f}ms'.format(
+                    name, batch_size, current['p99_ms'], previous['p99_ms']))
+    return found
+
+def print_results(results):
+    for name, result in sorted(results.items()):
+        fit = ', fit in {:.2f}s'.format(result['fit_secs']) if result.get('fit_secs') is not None else ''
+        print '*** {} (loaded in {:.2f}s{}, pickled {:.1f}MB, peak RSS {:.0f}MB) ***'.format(
+            name, result['load_secs'], fit, result['pickle_mb'], result['peak_rss_mb'])
+        for batch_size, stats in sorted(result['batches'].items(), key=lambda x:int(x[0])):
+            print '  batch {:>5}: {:>9.0f} docs/sec  p50 {:>9.2f}ms  p99 {:>9.2f}ms'.format(
+                batch_size, stats['docs_per_sec'], stats['p50_ms'], stats['p99_ms'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the production classification path.')
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--synthetic-only', action='store_true')
+    parser.add_argument('--n-docs', type=int, default=10000)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--tolerance', type=float, default=.2)
+    args = parser.parse_args()
+
+    names = sorted(PIPELINES)
+    if not args.synthetic_only:
+        for name, fname in sorted(ARTIFACTS.items()):
+            if osp.exists(fname):
+                names.append(name)
+            else:
+                print 'Skipping {}, {} not found'.format(name, fname)
+
+    pool = Pool(1, maxtasksperchild=1)
+    results = dict(pool.map(benchmark_model, [(name, args.n_docs, args.repeats) for name in names], chunksize=1))
+    pool.close()
+    pool.join()
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print 'Saved baseline to {}'.format(args.baseline)
+    elif osp.exists(args.baseline):
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print 'REGRESSION: {}'.format(regression)
+        if found:
+            sys.exit(1)
+        print 'No regressions against {}'.format(args.baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+""" Cache of fitted count matrices shared by every config of a hyperparam search. """
+import os
+import os.path as osp
+import hashlib
+import numbers
+import numpy as np
+
+from sklearn.base import clone
+from sklearn.externals import joblib
+
+
+def limited_columns(counts, max_df, min_df, max_features):
+    """ The columns CountVectorizer keeps for these limits, given the counts it fit without any.
+
+    Mirrors `CountVectorizer._limit_features` so the selected matrix is the same one a
+    vectorizer fit with these limits would have produced.
+    """
+    n_doc = counts.shape[0]
+    high = max_df if isinstance(max_df, numbers.Integral) else max_df * n_doc
+    low = min_df if isinstance(min_df, numbers.Integral) else min_df * n_doc
+    if high < low:
+        raise ValueError("max_df corresponds to < documents than min_df")
+    dfs = np.bincount(counts.indices, minlength=counts.shape[1])
+    tfs = np.asarray(counts.sum(axis=0)).ravel()
+    mask = np.ones(len(dfs), dtype=bool)
+    mask &= dfs <= high
+    mask &= dfs >= low
+    if max_features is not None and mask.sum() > max_features:
+        mask_inds = (-tfs[mask]).argsort()[:max_features]
+        new_mask = np.zeros(len(dfs), dtype=bool)
+        new_mask[np.where(mask)[0][mask_inds]] = True
+        mask = new_mask
+    return np.where(mask)[0]
+
+
+class FeatureCache(object):
+    """ Count matrices for each (cv fold, vectorizer params), fit once and reused across configs.
+
+    The vectorizer is fit without max_df/min_df/max_features, and each config's limits are applied
+    by selecting columns, so configs that differ only in those (or in downstream steps) share a fit.
+    With `cache_dir` the matrices are also written to disk and memory-mapped back, which shares
+    them between the processes of a parallel search and between runs.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.memory = {}
+        self.fingerprints = {}
+        if cache_dir and not osp.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                pass # made by another process in the meantime
+
+    def fingerprint(self, xs):
+        if id(xs) not in self.fingerprints:
+            md5 = hashlib.md5()
+            for x in xs:
+                md5.update(x.encode('utf8'))
+                md5.update('\0')
+            self.fingerprints[id(xs)] = md5.hexdigest()
+        return self.fingerprints[id(xs)]
+
+    def key(self, vectorizer, xs, train_idx):
+        md5 = hashlib.md5()
+        md5.update(self.fingerprint(xs))
+        md5.update(np.asarray(train_idx, dtype=np.int64).tostring())
+        md5.update(repr(sorted(vectorizer.get_params().items())))
+        return md5.hexdigest()
+
+    def load(self, key):
+        fname = osp.join(self.cache_dir, key + '.pkl')
+        if osp.exists(fname):
+            return joblib.load(fname, mmap_mode='r')
+        return None
+
+    def save(self, key, counts):
+        fname = osp.join(self.cache_dir, key + '.pkl')
+        tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+        joblib.dump(counts, tmp_fname)
+        os.rename(tmp_fname, fname) # atomic, so other processes never read a partial file
+
+    def counts(self, vectorizer, xs, train_idx, dev_idx):
+        """ Train and dev count matrices, as `vectorizer` would produce them on this fold. """
+        base = clone(vectorizer).set_params(max_df=1.0, min_df=1, max_features=None)
+        key = self.key(base, xs, train_idx)
+        if key not in self.memory:
+            counts = self.load(key) if self.cache_dir else None
+            if counts is None:
+                train_counts = base.fit_transform([xs[i] for i in train_idx])
+                dev_counts = base.transform([xs[i] for i in dev_idx])
+                counts = (train_counts, dev_counts)
+                if self.cache_dir:
+                    self.save(key, counts)
+            self.memory[key] = counts
+        train_counts, dev_counts = self.memory[key]
+        columns = limited_columns(train_counts, vectorizer.max_df, vectorizer.min_df, vectorizer.max_features)
+        return train_counts[:, columns], dev_counts[:, columns]
@@ -0,0 +1,34 @@
+from sklearn.pipeline import Pipeline
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import SGDClassifier
+
+# hashed features + sgd logistic regression pipeline def
+# nothing is fit before the classifier, so it stores no vocabulary and can be trained with `partial_fit_model`
+f1 = HashingVectorizer(
+        input=u'content',
+        encoding=u'utf-8',
+        decode_error=u'strict',
+        strip_accents=None,
+        lowercase=True,
+        preprocessor=None,
+        tokenizer=None,
+        stop_words=None,
+        ngram_range=(1, 2),
+        analyzer=u'word',
+        n_features=2**20,
+        binary=False,
+        norm='l2',
+        non_negative=False,
+        )
+sgd = SGDClassifier(
+    loss='log',
+    penalty='l2',
+    alpha=1e-5,
+    n_iter=10,
+    random_state=0,
+    verbose=0
+)
+model = Pipeline([
+        ('hash', f1),
+        ('sgd', sgd)
+    ])
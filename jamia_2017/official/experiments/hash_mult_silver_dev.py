@@ -0,0 +1,47 @@
+import numpy as np
+import numpy.random as npr
+from time import time
+
+from sklearn.externals import joblib
+
+from baseline_experiment_util import setup_baseline_data, random_search
+from hash_model import model
+from util import hms
+
+random_seed = 0
+n_jobs = -1 # all cores
+
+print 'Getting data...',
+data = setup_baseline_data(train_regime='silver', test_regime='silver', random_seed=random_seed,
+                           cache_dir='../data/cache')
+train_data = data['train_data']
+all_B_over_U = data['all_B_over_U']
+print 'Done'
+
+npr.seed(random_seed) # same draws on a rerun, so a resumed search skips the right configs
+N = 500
+random_hyperparams = {
+    'hash__ngram_range':[(1,n) for n in npr.randint(1,4, N)],
+    'hash__n_features':2**npr.randint(16,23, N),
+    'hash__binary':npr.choice([True, False], N),
+    'sgd__alpha':npr.choice(np.logspace(-7,-2, 10000), N),
+    'sgd__penalty':npr.choice(['l1', 'l2', 'elasticnet'], N),
+    'sgd__n_iter':npr.randint(5,50, N)
+}
+
+score_kwds = {
+    'xs':train_data.array('text'),
+    'ys':train_data.array('is_multiple'),
+    'bs':train_data.array('is_biased'),
+    'all_B_over_U':all_B_over_U,
+    'fit_weight_kwd':'sgd__sample_weight',
+    'n_cv_splits':5,
+    'random_seed':random_seed
+}
+
+print 'Starting Experiments...'
+t0 = time()
+experiments = random_search(model, random_hyperparams, 'best_hash_mult_silver.pkl', n_jobs=n_jobs, log_fname='hash_mult_silver_dev.log', **score_kwds)
+print 'Done {}:{}:{} seconds. Writing out experiments'.format(*hms(time()-t0))
+joblib.dump(experiments, 'hash_mult_silver_dev.pkl')
+print 'All done'
@@ -0,0 +1,6 @@
+nohup python hash_sick_biased_dev.py > hash_sick_biased_dev.out
+nohup python hash_sick_gold_dev.py > hash_sick_gold_dev.out
+nohup python hash_sick_silver_dev.py > hash_sick_silver_dev.out
+nohup python hash_mult_biased_dev.py > hash_mult_biased_dev.out
+nohup python hash_mult_gold_dev.py > hash_mult_gold_dev.out
+nohup python hash_mult_silver_dev.py > hash_mult_silver_dev.out
@@ -1,6 +1,6 @@
-nohup python lr_sick_biased_dev.py > lr_sick_biased_dev.out &
-nohup python lr_sick_gold_dev.py > lr_sick_gold_dev.out &
-nohup python lr_sick_silver_dev.py > lr_sick_silver_dev.out &
-nohup python lr_mult_biased_dev.py > lr_mult_biased_dev.out &
-nohup python lr_mult_gold_dev.py > lr_mult_gold_dev.out &
-nohup python lr_mult_silver_dev.py > lr_mult_silver_dev.out &
+nohup python lr_sick_biased_dev.py > lr_sick_biased_dev.out
+nohup python lr_sick_gold_dev.py > lr_sick_gold_dev.out
+nohup python lr_sick_silver_dev.py > lr_sick_silver_dev.out
+nohup python lr_mult_biased_dev.py > lr_mult_biased_dev.out
+nohup python lr_mult_gold_dev.py > lr_mult_gold_dev.out
+nohup python lr_mult_silver_dev.py > lr_mult_silver_dev.out
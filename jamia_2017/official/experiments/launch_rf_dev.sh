@@ -1,6 +1,6 @@
-nohup python rf_sick_biased_dev.py > rf_sick_biased_dev.out &
-nohup python rf_sick_gold_dev.py > rf_sick_gold_dev.out &
-nohup python rf_sick_silver_dev.py > rf_sick_silver_dev.out &
-nohup python rf_mult_biased_dev.py > rf_mult_biased_dev.out &
-nohup python rf_mult_gold_dev.py > rf_mult_gold_dev.out &
-nohup python rf_mult_silver_dev.py > rf_mult_silver_dev.out &
+nohup python rf_sick_biased_dev.py > rf_sick_biased_dev.out
+nohup python rf_sick_gold_dev.py > rf_sick_gold_dev.out
+nohup python rf_sick_silver_dev.py > rf_sick_silver_dev.out
+nohup python rf_mult_biased_dev.py > rf_mult_biased_dev.out
+nohup python rf_mult_gold_dev.py > rf_mult_gold_dev.out
+nohup python rf_mult_silver_dev.py > rf_mult_silver_dev.out
@@ -1,6 +1,6 @@
-nohup python svm_sick_biased_dev.py > svm_sick_biased_dev.out &
-nohup python svm_sick_gold_dev.py > svm_sick_gold_dev.out &
-nohup python svm_sick_silver_dev.py > svm_sick_silver_dev.out &
-nohup python svm_mult_biased_dev.py > svm_mult_biased_dev.out &
-nohup python svm_mult_gold_dev.py > svm_mult_gold_dev.out &
-nohup python svm_mult_silver_dev.py > svm_mult_silver_dev.out &
+nohup python svm_sick_biased_dev.py > svm_sick_biased_dev.out
+nohup python svm_sick_gold_dev.py > svm_sick_gold_dev.out
+nohup python svm_sick_silver_dev.py > svm_sick_silver_dev.out
+nohup python svm_mult_biased_dev.py > svm_mult_biased_dev.out
+nohup python svm_mult_gold_dev.py > svm_mult_gold_dev.out
+nohup python svm_mult_silver_dev.py > svm_mult_silver_dev.out
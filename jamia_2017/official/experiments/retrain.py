@@ -0,0 +1,202 @@
+""" Retrain a deployed model on the reviews/tweets adjudicated in Mongo since its last version.
+
+Usage:
+    python retrain.py yelp_sick               # train a candidate, validate it and write a new version
+    python retrain.py yelp_sick --promote     # ... and make it the version the classify services use
+    python retrain.py yelp_sick --canary .1   # ... or have them also score 10% of the texts with it
+
+Labels are posted to the API's /label/review and /label/tweet endpoints and stored under `label`.
+A random `--holdout` of the labels added since the last version is kept for validation. The
+candidate keeps the deployed model's configuration (no search). Only the hashed SGD pipeline of
+hash_model.py is updated incrementally, with `partial_fit_model` on the new labels. Every other
+pipeline, the CountVectorizer `lr_model` behind best_lr_sick_silver.pkl included, is retrained from
+scratch: a clone is fit, vocabulary and all, on the offline training data plus every production
+label, which takes as long as training the original did. Training uses `calc_importance_weights` and
+the candidate is only published when its IW-F1 on the holdout is at least the deployed model's.
+Versions are written next to the deployed artifact under `versions/`, with a `<target>.json`
+manifest recording how each was made, and deployed through `<target>.deploy.json`, which the
+services' model registry (src/common/registry.py) watches.
+"""
+import argparse
+import json
+import os
+import os.path as osp
+import sys
+from copy import deepcopy
+from datetime import datetime
+
+import numpy as np
+import numpy.random as npr
+from pymongo import MongoClient
+
+from sklearn.base import clone
+from sklearn.externals import joblib
+from sklearn.feature_extraction.text import HashingVectorizer
+
+from baseline_experiment_util import (setup_baseline_data, calc_importance_weights, partial_fit_model,
+                                      importance_weighted_precision_recall, f1)
+
+SRC = osp.join(osp.dirname(osp.abspath(__file__)), '..', '..', '..', 'src')
+TARGETS = {
+    'yelp_sick': {'collection':'reviews', 'text':'text', 'label':'is_foodborne', 'base_data':True,
+                  'model':osp.join(SRC, 'yelp-classify', 'final_yelp_models', 'final_yelp_sick_model.gz')},
+    'yelp_mult': {'collection':'reviews', 'text':'text', 'label':'is_multiple', 'base_data':True,
+                  'model':osp.join(SRC, 'yelp-classify', 'final_yelp_models', 'final_yelp_mult_model.gz')},
+    'twitter_sick': {'collection':'tweets', 'text':'full_text', 'label':'is_foodborne', 'base_data':False,
+                     'model':osp.join(SRC, 'twitter-classify', 'final_twitter_models', 'best_lr_sick_silver.pkl')},
+}
+# a production doc counts as biased (surfaced to the adjudicators by the classifier) at this score
+BIAS_THRESHOLD = .5
+
+def read_manifest(fname):
+    if not osp.exists(fname):
+        return []
+    with open(fname) as f:
+        return json.load(f)
+
+def write_manifest(fname, versions):
+    tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp_fname, 'w') as f:
+        json.dump(versions, f, indent=2, sort_keys=True)
+    os.rename(tmp_fname, fname)
+
+def deploy(fname, **changes):
+    """ Update the deploy file; the classify services pick it up before their next batch. """
+    deployment = read_manifest(fname) if osp.exists(fname) else {}
+    deployment.update(changes)
+    write_manifest(fname, deployment)
+
+def production_labels(db, target, since=None):
+    """ Texts, labels, bias flags and label times of the docs adjudicated after `since`. """
+    collection = db[target['collection']]
+    query = {'label.' + target['label']: {'$exists': True}}
+    if since is not None:
+        query['label.labeled_at'] = {'$gt': since}
+    fields = {target['text']:1, 'label':1, 'classification.total_score':1}
+    xs, ys, bs, labeled_ats = [], [], [], []
+    for doc in collection.find(query, fields).sort('label.labeled_at', 1):
+        xs.append(doc[target['text']])
+        ys.append(int(doc['label'][target['label']]))
+        bs.append(doc.get('classification', {}).get('total_score', 0.) >= BIAS_THRESHOLD)
+        labeled_ats.append(doc['label']['labeled_at'])
+    return np.array(xs, dtype=object), np.array(ys, dtype=np.int8), np.array(bs, dtype=bool), labeled_ats
+
+def production_B_over_U(db, target):
+    """ Fraction of the classified docs that the deployed classifier surfaces. """
+    collection = db[target['collection']]
+    classified = collection.count_documents({'classification': {'$exists': True}})
+    flagged = collection.count_documents({'classification.total_score': {'$gte': BIAS_THRESHOLD}})
+    return flagged / float(max(classified, 1))
+
+def can_partial_fit(model):
+    """ Whether only the classifier is fit, so the model can be updated with `partial_fit_model`. """
+    steps = getattr(model, 'steps', [])
+    return (bool(steps) and hasattr(steps[-1][1], 'partial_fit') and
+            all(isinstance(step, HashingVectorizer) for name, step in steps[:-1]))
+
+def iw_f1(model, xs, ys, bs, all_B_over_U):
+    scores = model.predict_proba(xs)[:,1]
+    precision, recall = importance_weighted_precision_recall(ys, scores, calc_importance_weights(bs, all_B_over_U))
+    return f1(precision, recall)
+
+def main():
+    parser = argparse.ArgumentParser(description='Retrain a deployed model on newly adjudicated production data.')
+    parser.add_argument('target', choices=sorted(TARGETS))
+    parser.add_argument('--mongo-uri', default=os.environ.get('MONGO_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--database', default=os.environ.get('MONGO_DATABASE', 'fdbnyc'))
+    parser.add_argument('--holdout', type=float, default=.2)
+    parser.add_argument('--min-validation', type=int, default=50)
+    parser.add_argument('--train-regime', default='silver')
+    parser.add_argument('--data-path', default='../data')
+    parser.add_argument('--random-seed', type=int, default=0)
+    parser.add_argument('--promote', action='store_true')
+    parser.add_argument('--canary', type=float, default=None, help='fraction of texts to also score with it')
+    args = parser.parse_args()
+
+    target = TARGETS[args.target]
+    versions_dir = osp.join(osp.dirname(target['model']), 'versions')
+    manifest_fname = osp.join(versions_dir, args.target + '.json')
+    deploy_fname = osp.join(versions_dir, args.target + '.deploy.json')
+    versions = read_manifest(manifest_fname)
+    since = datetime.strptime(versions[-1]['labeled_until'], '%Y-%m-%dT%H:%M:%S.%f') if versions else None
+    active = read_manifest(deploy_fname).get('active') if osp.exists(deploy_fname) else None
+    model_fname = osp.join(versions_dir, active) if active else target['model']
+    model = joblib.load(model_fname)
+    print 'Current model: {}'.format(model_fname)
+
+    db = MongoClient(args.mongo_uri)[args.database]
+    all_B_over_U = production_B_over_U(db, target)
+    xs, ys, bs, labeled_ats = production_labels(db, target, since)
+    n_validation = int(round(args.holdout * len(xs)))
+    if n_validation < args.min_validation:
+        print 'Only {} new labels since {}, need {} to validate'.format(len(xs), since, args.min_validation)
+        sys.exit(1)
+    rs = npr.RandomState(args.random_seed)
+    is_validation = np.zeros(len(xs), dtype=bool)
+    is_validation[rs.choice(len(xs), n_validation, replace=False)] = True
+    print '{} new labels, {} held out for validation, production B/U {:2.4f}'.format(len(xs), n_validation, all_B_over_U)
+
+    if can_partial_fit(model):
+        method = 'partial_fit'
+        train_xs, train_ys, train_bs = xs[~is_validation], ys[~is_validation], bs[~is_validation]
+        candidate = deepcopy(model)
+        partial_fit_model(candidate, [(train_xs, train_ys, calc_importance_weights(train_bs, all_B_over_U))],
+                          classes=candidate.steps[-1][1].classes_)
+    else:
+        # a full fit from scratch: a CountVectorizer's vocabulary cannot be extended in place
+        method = 'refit'
+        # every production label except this round's held out ones, weighted by the production B/U
+        old_xs, old_ys, old_bs, _ = production_labels(db, target, None) if since else (xs, ys, bs, None)
+        held_out = set(xs[is_validation])
+        keep = np.array([x not in held_out for x in old_xs], dtype=bool)
+        train_xs, train_ys = old_xs[keep], old_ys[keep]
+        train_iws = calc_importance_weights(old_bs[keep], all_B_over_U)
+        if target['base_data']:
+            data = setup_baseline_data(train_regime=args.train_regime, test_regime='silver', data_path=args.data_path,
+                                       random_seed=args.random_seed, cache_dir=osp.join(args.data_path, 'cache'))
+            base = data['train_data']
+            train_xs = np.concatenate([base.array('text'), train_xs])
+            train_ys = np.concatenate([base.array(target['label']), train_ys])
+            train_iws = np.concatenate([calc_importance_weights(base.array('is_biased'), data['all_B_over_U']), train_iws])
+        candidate = clone(model)
+        candidate.fit(train_xs, train_ys, **{'{}__sample_weight'.format(candidate.steps[-1][0]):train_iws})
+    print 'Trained a candidate with {} on {} docs'.format(method, len(train_xs))
+
+    val_xs, val_ys, val_bs = xs[is_validation], ys[is_validation], bs[is_validation]
+    current_f1 = iw_f1(model, val_xs, val_ys, val_bs, all_B_over_U)
+    candidate_f1 = iw_f1(candidate, val_xs, val_ys, val_bs, all_B_over_U)
+    print 'Holdout IW-F1: current {:2.4f}, candidate {:2.4f}'.format(current_f1, candidate_f1)
+    if candidate_f1 < current_f1:
+        print 'Candidate is worse than the current model, not publishing it'
+        sys.exit(1)
+
+    trained_at = datetime.utcnow()
+    fname = '{}-{}.pkl'.format(args.target, trained_at.strftime('%Y%m%d%H%M%S'))
+    if not osp.exists(versions_dir):
+        os.makedirs(versions_dir)
+    # uncompressed, so the services can memory-map it
+    tmp_fname = osp.join(versions_dir, '{}.{}.tmp'.format(fname, os.getpid()))
+    joblib.dump(candidate, tmp_fname)
+    os.rename(tmp_fname, osp.join(versions_dir, fname))
+    versions.append({'fname':fname,
+                     'parent':osp.basename(model_fname),
+                     'method':method,
+                     'trained_at':trained_at.isoformat(),
+                     'labeled_until':max(labeled_ats).strftime('%Y-%m-%dT%H:%M:%S.%f'),
+                     'n_train':len(train_xs),
+                     'n_validation':n_validation,
+                     'all_B_over_U':all_B_over_U,
+                     'current_iw_f1':current_f1,
+                     'iw_f1':candidate_f1})
+    write_manifest(manifest_fname, versions)
+    print 'Published {}'.format(osp.join(versions_dir, fname))
+
+    if args.promote:
+        deploy(deploy_fname, active=fname, canary=None, canary_fraction=0.)
+        print 'Promoted it in {}'.format(deploy_fname)
+    elif args.canary:
+        deploy(deploy_fname, canary=fname, canary_fraction=args.canary)
+        print 'Deployed it as a canary on {:.0%} of the texts'.format(args.canary)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Batched reads for the classify services.
+
+read_batches projects the documents down to the fields the caller needs, asks the server for a
+whole batch per round trip, and reads the next batch on a thread while the caller is still
+scoring the current one."""
+import threading
+from itertools import islice
+try:
+	from queue import Queue, Full
+except ImportError:
+	from Queue import Queue, Full
+
+PUT_TIMEOUT_SECS = 1
+
+
+def make_batches(n, iterable):
+	i = iter(iterable)
+	piece = list(islice(i, n))
+	while piece:
+		yield piece
+		piece = list(islice(i, n))
+
+
+def prefetch(batches, depth=1):
+	"""Iterate batches on a thread, keeping up to depth of them ready ahead of the consumer."""
+	queue = Queue(maxsize=depth)
+	stop = threading.Event()
+	done = object()
+
+	def put(item):
+		while not stop.is_set():
+			try:
+				queue.put(item, timeout=PUT_TIMEOUT_SECS)
+				return True
+			except Full:
+				pass
+		return False
+
+	def produce():
+		try:
+			for batch in batches:
+				if not put(batch):
+					return
+			put(done)
+		except Exception as e:
+			put(e)
+
+	thread = threading.Thread(target=produce)
+	thread.daemon = True
+	thread.start()
+	try:
+		while True:
+			item = queue.get()
+			if item is done:
+				return
+			if isinstance(item, Exception):
+				raise item
+			yield item
+	finally:
+		# a consumer that stops early releases the producer instead of leaving it blocked on put
+		stop.set()
+
+
+def read_batches(collection, query, fields, batch_size, depth=1, sort=None):
+	"""Lists of up to batch_size documents matching query, with only fields (and _id)."""
+	cursor = collection.find(query, fields).batch_size(batch_size)
+	if sort:
+		cursor = cursor.sort(sort)
+	try:
+		for batch in prefetch(make_batches(batch_size, cursor), depth):
+			yield batch
+	finally:
+		cursor.close()
@@ -0,0 +1,96 @@
+"""Check that two classify workers sharing buckets never score a document twice.
+
+	MONGO_URI=mongodb://localhost:27017/ python common/check_leases.py
+
+Runs against a throwaway database on the server at MONGO_URI, which is dropped afterwards, and
+exits without checking anything when no server answers there. Two workers split a small backlog
+the way the classify services do. The first has a short lease and stalls in the middle of a
+bucket for longer than the lease, so the second takes that bucket over from its checkpoint and
+finishes the backlog. The first must then fail to renew its lease and drop the batch it had
+scored, and every document must have been scored exactly once."""
+from __future__ import print_function
+import sys
+import time
+import uuid
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import ServerSelectionTimeoutError
+from dbaccess import MONGO_URI
+from batching import read_batches
+from checkpoint import Checkpoint, ORDER
+from leases import Worker, bucket_of, prepare
+
+DOCS = 2000
+BATCH = 10
+SHORT_LEASE_SECS = 1
+NAME = 'check-leases'
+
+
+def classify_bucket(db, worker, bucket, stall=None):
+	"""classify_bucket of the classify services with a counter for scores. False if the lease was lost."""
+	checkpoint = Checkpoint(db, '%s:%d' % (NAME, bucket))
+	query = checkpoint.query({'bucket': bucket, 'classification': {'$exists': False}})
+	for i, batch in enumerate(read_batches(db.docs, query, {'_id': 1}, BATCH, sort=ORDER)):
+		requests = [UpdateOne({'_id': x['_id']}, {'$set': {'classification': worker.owner}, '$inc': {'scored': 1}})
+					for x in batch]
+		if stall is not None and i == 1:
+			stall()
+		if not worker.renew(bucket):
+			return False
+		db.docs.bulk_write(requests, ordered=False)
+		checkpoint.advance(batch)
+	checkpoint.finish()
+	return True
+
+
+def run(db, worker):
+	for bucket in worker.buckets():
+		classify_bucket(db, worker, bucket)
+
+
+def check(db):
+	db.docs.insert_many([{'_id': i, 'bucket': bucket_of(i)} for i in range(DOCS)])
+	prepare(db.docs)
+	first = Worker(db, NAME, lease_secs=SHORT_LEASE_SECS)
+	second = Worker(db, NAME)
+	buckets = first.buckets()
+	stalled = next(buckets)
+	stalls = []
+
+	def stall():
+		# the second worker sees the lease expire and takes the bucket over while the first is busy
+		time.sleep(SHORT_LEASE_SECS + 1)
+		run(db, second)
+		stalls.append(stalled)
+
+	assert not classify_bucket(db, first, stalled, stall), 'renewed a lease that had expired'
+	assert stalls, 'bucket %d has fewer than %d documents, nothing was left to take over' % (stalled, 2 * BATCH)
+	for bucket in buckets:
+		classify_bucket(db, first, bucket)
+	taken_over = db.docs.count_documents({'bucket': stalled, 'classification': second.owner})
+	assert taken_over, 'the second worker did not finish bucket %d' % stalled
+	unscored = db.docs.count_documents({'scored': {'$exists': False}})
+	twice = db.docs.count_documents({'scored': {'$gt': 1}})
+	assert unscored == 0, '%d documents were not scored' % unscored
+	assert twice == 0, '%d documents were scored more than once' % twice
+	print('ok: %d documents scored once each, %d of bucket %d by the worker that took it over'
+		  % (DOCS, taken_over, stalled))
+
+
+def main():
+	client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=2000)
+	try:
+		client.admin.command('ping')
+	except ServerSelectionTimeoutError:
+		print('skipped: no MongoDB server at %s' % MONGO_URI)
+		return 0
+	name = 'check_leases_%s' % uuid.uuid4().hex[:8]
+	try:
+		check(client[name])
+	finally:
+		client.drop_database(name)
+		client.close()
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,62 @@
+"""Progress markers for classify runs, so a run that dies can resume where it stopped.
+
+A run walks the unclassified documents in _id order and records the last _id of every batch it
+has fully written, together with its throughput so far. If the previous run did not finish, the
+next one continues after that _id instead of scanning the collection from the start again."""
+import time
+from datetime import datetime
+
+COLLECTION = 'classify_checkpoints'
+ORDER = [('_id', 1)]
+
+
+class Checkpoint(object):
+	def __init__(self, db, name):
+		self.collection = db[COLLECTION]
+		self.name = name
+		self.last_time = time.time()
+		state = self.collection.find_one({'_id': name}) or {}
+		self.resumed = state.get('status') == 'running'
+		if self.resumed:
+			self.state = state
+			self.state['resumes'] = state.get('resumes', 0) + 1
+		else:
+			self.state = {'_id': name, 'status': 'running', 'run_started': datetime.utcnow(), 'last_id': None,
+						  'docs': 0, 'batches': 0, 'active_secs': 0.0, 'resumes': 0}
+			self.collection.replace_one({'_id': name}, self.state, upsert=True)
+
+	def query(self, query):
+		"""query restricted to the documents after the last checkpoint of this run."""
+		if self.state['last_id'] is None:
+			return query
+		return {'$and': [query, {'_id': {'$gt': self.state['last_id']}}]}
+
+	def advance(self, batch):
+		"""Record that every document in batch (read in _id order) has been written."""
+		now = time.time()
+		secs = now - self.last_time
+		self.last_time = now
+		self.state['last_id'] = batch[-1]['_id']
+		self.state['docs'] += len(batch)
+		self.state['batches'] += 1
+		self.state['active_secs'] += secs
+		self.state['docs_per_sec'] = self.state['docs'] / self.state['active_secs'] if self.state['active_secs'] else None
+		self.state['last_batch_docs_per_sec'] = len(batch) / secs if secs else None
+		self.state['updated_at'] = datetime.utcnow()
+		self.collection.replace_one({'_id': self.name}, self.state, upsert=True)
+
+	def finish(self):
+		self.state['status'] = 'done'
+		self.state['finished_at'] = datetime.utcnow()
+		self.collection.replace_one({'_id': self.name}, self.state, upsert=True)
+
+	def stats(self):
+		return {k: self.state.get(k) for k in ('docs', 'batches', 'active_secs', 'docs_per_sec', 'resumes')}
+
+
+def combined_stats(checkpoints):
+	"""Throughput over several checkpoints, e.g. the buckets one worker handled in a run."""
+	stats = {k: sum(c.state[k] for c in checkpoints) for k in ('docs', 'batches', 'active_secs', 'resumes')}
+	stats['docs_per_sec'] = stats['docs'] / stats['active_secs'] if stats['active_secs'] else None
+	stats['buckets'] = len(checkpoints)
+	return stats
@@ -0,0 +1,143 @@
+"""Shared MongoDB access for the fdbnyc services.
+
+Every service gets its client through get_db() so pool sizing, write concern and cursor
+batch sizes are configured in one place (through MONGO_* environment variables set in
+docker-compose.yml). The client is created lazily and re-created when the process id
+changes, so it is safe to import this module before gunicorn forks its workers."""
+import os
+import threading
+from collections import defaultdict
+from pymongo import MongoClient
+from pymongo import WriteConcern
+from pymongo import monitoring
+
+MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://mongo:27017/')
+DATABASE = os.environ.get('MONGO_DATABASE', 'fdbnyc')
+MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 10))
+MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', 0))
+WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 10000))
+WRITE_CONCERN_W = int(os.environ.get('MONGO_WRITE_CONCERN_W', 1))
+WRITE_CONCERN_J = os.environ.get('MONGO_WRITE_CONCERN_J') == '1'
+BATCH_SIZE = int(os.environ.get('MONGO_BATCH_SIZE', 1000))
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_db = None
+_listeners = []
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counts = defaultdict(int)
+
+	def incr(self, name, value=1):
+		with self.lock:
+			self.counts[name] += value
+
+	def snapshot(self):
+		with self.lock:
+			stats = dict(self.counts)
+		stats['in_use'] = stats.get('checked_out', 0) - stats.get('checked_in', 0)
+		stats['open'] = stats.get('created', 0) - stats.get('closed', 0)
+		return stats
+
+	def pool_created(self, event):
+		pass
+
+	def pool_cleared(self, event):
+		self.incr('pool_cleared')
+
+	def pool_closed(self, event):
+		pass
+
+	def connection_created(self, event):
+		self.incr('created')
+
+	def connection_ready(self, event):
+		pass
+
+	def connection_closed(self, event):
+		self.incr('closed')
+
+	def connection_check_out_started(self, event):
+		pass
+
+	def connection_check_out_failed(self, event):
+		self.incr('check_out_failed')
+
+	def connection_checked_out(self, event):
+		self.incr('checked_out')
+
+	def connection_checked_in(self, event):
+		self.incr('checked_in')
+
+
+pool_stats = PoolStats()
+
+
+def add_listener(listener):
+	"""Register a pymongo event listener; it applies to clients created after this call."""
+	_listeners.append(listener)
+
+
+def client_options():
+	return dict(maxPoolSize=MAX_POOL_SIZE,
+				minPoolSize=MIN_POOL_SIZE,
+				waitQueueTimeoutMS=WAIT_QUEUE_TIMEOUT_MS,
+				connect=False,
+				event_listeners=[pool_stats] + _listeners)
+
+
+def write_concern():
+	return WriteConcern(w=WRITE_CONCERN_W, j=WRITE_CONCERN_J or None)
+
+
+def get_client():
+	global _client, _client_pid, _db
+	with _lock:
+		if _client is None or _client_pid != os.getpid():
+			# a client inherited across fork must not be reused; drop it without closing the parent's sockets
+			_client = MongoClient(MONGO_URI, **client_options())
+			_client_pid = os.getpid()
+			_db = _client.get_database(DATABASE, write_concern=write_concern())
+		return _client
+
+
+def get_db():
+	get_client()
+	return _db
+
+
+def get_async_db():
+	"""A Motor database configured like get_db(), for the asyncio serving mode.
+
+	A Motor client belongs to the event loop it is first used on, so this returns a new one on
+	every call: call it once per loop (e.g. at application startup) and close its client after."""
+	from motor.motor_asyncio import AsyncIOMotorClient
+	client = AsyncIOMotorClient(MONGO_URI, **client_options())
+	return client.get_database(DATABASE, write_concern=write_concern())
+
+
+def close():
+	global _client, _client_pid, _db
+	with _lock:
+		if _client is not None and _client_pid == os.getpid():
+			_client.close()
+		_client = None
+		_client_pid = None
+		_db = None
+
+
+class LazyDatabase(object):
+	"""Module-level stand-in for a Database that resolves the client on first use in each process."""
+
+	def __getattr__(self, name):
+		return getattr(get_db(), name)
+
+	def __getitem__(self, name):
+		return get_db()[name]
+
+
+lazy_db = LazyDatabase()
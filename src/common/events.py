@@ -0,0 +1,89 @@
+"""Capped-collection event bus that hands work from one pipeline stage to the next.
+
+A stage publishes an event when it has written new data and downstream stages tail the
+collection, so they start as soon as their input is ready instead of at a fixed time.
+A capped collection is used instead of change streams because those need a replica set."""
+import time
+import logging
+from datetime import datetime
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid
+from pymongo.errors import PyMongoError
+
+BUS = 'pipeline_events'
+BUS_SIZE = 16 * 1024 * 1024
+AWAIT_MS = 5000
+
+logger = logging.getLogger(__name__)
+
+
+def ensure_bus(db):
+	if BUS not in db.collection_names():
+		try:
+			db.create_collection(BUS, capped=True, size=BUS_SIZE)
+			# a tailable cursor on an empty capped collection dies immediately
+			db[BUS].insert_one({'stage': 'bus.created', 'published_at': datetime.utcnow()})
+		except CollectionInvalid:
+			pass
+	return db[BUS]
+
+
+def publish(db, stage, **payload):
+	event = dict(payload, stage=stage, published_at=datetime.utcnow())
+	ensure_bus(db).insert_one(event)
+	return event
+
+
+def latest_id(bus):
+	last = list(bus.find({}, {'_id': 1}).sort('$natural', -1).limit(1))
+	return last[0]['_id'] if last else None
+
+
+def consume(db, stages, handler, fallback_secs=3600):
+	"""Run handler once to catch up, then again whenever one of stages publishes an event.
+
+	Events published while handler is running are coalesced into a single follow-up run.
+	handler also runs after fallback_secs without events, so a lost event only delays work."""
+	bus = ensure_bus(db)
+
+	def run():
+		handled_until = latest_id(bus)
+		try:
+			handler()
+		except Exception:
+			logger.warning('Exception while handling pipeline event', exc_info=True)
+		return handled_until, time.time()
+
+	handled_until, last_run = run()
+	while True:
+		try:
+			query = {'stage': {'$in': stages}}
+			if handled_until is not None:
+				query['_id'] = {'$gt': handled_until}
+			cursor = bus.find(query, cursor_type=CursorType.TAILABLE_AWAIT).max_await_time_ms(AWAIT_MS)
+			while cursor.alive:
+				for event in cursor:
+					if handled_until is None or event['_id'] > handled_until:
+						handled_until, last_run = run()
+				if time.time() - last_run > fallback_secs:
+					handled_until, last_run = run()
+		except PyMongoError:
+			logger.warning('Exception while tailing the pipeline event bus', exc_info=True)
+		time.sleep(1)
+
+
+def freshness_secs(document, field, now):
+	"""Seconds between field, set when the document entered the pipeline, and now."""
+	if not document.get(field):
+		return None
+	return (now - document[field]).total_seconds()
+
+
+def freshness_stats(seconds):
+	if not seconds:
+		return {'count': 0}
+	ordered = sorted(seconds)
+	return {'count': len(ordered),
+			'mean': sum(ordered) / len(ordered),
+			'p50': ordered[len(ordered) // 2],
+			'max': ordered[-1]}
@@ -0,0 +1,87 @@
+"""Partitioned work claiming, so several replicas of a classify service can split its backlog.
+
+Every document gets a bucket (a hash of its _id) when it is ingested. A worker leases one bucket
+at a time in the classify_leases collection, works through that bucket's backlog and renews the
+lease before writing each batch. A lease that is not renewed within CLASSIFY_LEASE_SECS (its
+worker died or stalled) is taken over by another worker, which resumes from the bucket's
+checkpoint. There are many more buckets than replicas, so the work is shared out evenly."""
+import os
+import uuid
+import zlib
+import socket
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from batching import make_batches
+
+COLLECTION = 'classify_leases'
+BUCKETS = 64
+LEASE_SECS = int(os.environ.get('CLASSIFY_LEASE_SECS', 600))
+EXPIRED = datetime(1970, 1, 1)
+DUPLICATE_KEY = 11000
+
+
+def bucket_of(_id):
+	return (zlib.crc32((u'%s' % (_id,)).encode('utf8')) & 0xffffffff) % BUCKETS
+
+
+def prepare(collection, batch_size=10000):
+	"""Index the per-bucket scan and give a bucket to unclassified documents ingested without one."""
+	collection.create_index([('bucket', ASCENDING), ('_id', ASCENDING)])
+	missing = collection.find({'bucket': None, 'classification': {'$exists': False}}, {'_id': 1})
+	for batch in make_batches(batch_size, missing):
+		collection.bulk_write([UpdateOne({'_id': x['_id']}, {'$set': {'bucket': bucket_of(x['_id'])}}) for x in batch],
+							  ordered=False)
+
+
+class Worker(object):
+	def __init__(self, db, name, lease_secs=LEASE_SECS):
+		self.leases = db[COLLECTION]
+		self.name = name
+		self.lease_secs = lease_secs
+		self.owner = '%s:%s:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+		try:
+			self.leases.bulk_write([UpdateOne({'_id': self.lease_id(bucket)},
+											  {'$setOnInsert': {'owner': None, 'expires_at': EXPIRED}}, upsert=True)
+									for bucket in range(BUCKETS)], ordered=False)
+		except BulkWriteError as e:
+			# another replica created some of them at the same time; anything else is a real failure
+			if e.details.get('writeConcernErrors') or any(x['code'] != DUPLICATE_KEY for x in e.details['writeErrors']):
+				raise
+
+	def lease_id(self, bucket):
+		return '%s:%d' % (self.name, bucket)
+
+	def claim(self, exclude=()):
+		"""Lease a bucket that is free or expired and not in exclude. None if there is none."""
+		now = datetime.utcnow()
+		lease = self.leases.find_one_and_update(
+			{'_id': {'$in': [self.lease_id(b) for b in range(BUCKETS) if b not in exclude]},
+			 '$or': [{'expires_at': {'$lt': now}}, {'owner': self.owner}]},
+			{'$set': {'owner': self.owner, 'expires_at': now + timedelta(seconds=self.lease_secs)}},
+			return_document=ReturnDocument.AFTER)
+		return int(lease['_id'].rsplit(':', 1)[1]) if lease else None
+
+	def renew(self, bucket):
+		"""Extend the lease on bucket. False if another worker has taken it over."""
+		result = self.leases.update_one(
+			{'_id': self.lease_id(bucket), 'owner': self.owner},
+			{'$set': {'expires_at': datetime.utcnow() + timedelta(seconds=self.lease_secs)}})
+		return result.matched_count == 1
+
+	def release(self, bucket):
+		self.leases.update_one({'_id': self.lease_id(bucket), 'owner': self.owner},
+							   {'$set': {'owner': None, 'expires_at': EXPIRED}})
+
+	def buckets(self):
+		"""Lease buckets one at a time until each has been handled here or is leased by another worker."""
+		done = set()
+		while True:
+			bucket = self.claim(done)
+			if bucket is None:
+				return
+			done.add(bucket)
+			try:
+				yield bucket
+			finally:
+				self.release(bucket)
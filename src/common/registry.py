@@ -0,0 +1,114 @@
+"""Versioned model artifacts that the classify services switch between without restarting.
+
+A model directory holds the artifact the service shipped with (e.g. final_yelp_sick_model.gz)
+and a versions/ folder written by jamia_2017/official/experiments/retrain.py:
+
+	versions/<name>-<timestamp>.pkl   one artifact per version
+	versions/<name>.json              how each version was trained and validated
+	versions/<name>.deploy.json       {"active": <fname>, "canary": <fname>, "canary_fraction": <float>}
+
+Services call refresh() between batches. A changed deploy file is loaded in full before the
+references are swapped, so a batch always runs on the model it started with and a version that
+fails to load leaves the previous one in place. Versions are stored uncompressed and memory-mapped.
+The shipped artifact is reloaded when its file changes, and its version includes a hash of its
+contents, so replacing it in place does not reuse scores cached for the old one."""
+import os
+import json
+import hashlib
+import random
+import logging
+from collections import namedtuple
+from sklearn.externals import joblib
+
+logger = logging.getLogger(__name__)
+
+Loaded = namedtuple('Loaded', ['fname', 'version', 'model', 'mtime'])
+
+
+def file_digest(path, chunk_size=1 << 20):
+	digest = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(chunk_size), b''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+
+class ModelRegistry(object):
+	def __init__(self, model_dir, name, default_fname, wrap=None):
+		self.name = name
+		self.versions_dir = os.path.join(model_dir, 'versions')
+		self.deploy_fname = os.path.join(self.versions_dir, name + '.deploy.json')
+		self.default_path = os.path.join(model_dir, default_fname)
+		self.wrap = wrap or (lambda model: model)
+		self.deploy_mtime = None
+		self.active = None
+		self.canary = None
+		self.canary_fraction = 0.0
+		self.refresh()
+
+	def read_deployment(self):
+		try:
+			with open(self.deploy_fname) as f:
+				return json.load(f)
+		except (IOError, OSError, ValueError):
+			return {}
+
+	def load(self, fname, current):
+		"""The version in fname (the default artifact when None), reusing current if it is the same one."""
+		path = self.default_path if fname is None else os.path.join(self.versions_dir, fname)
+		mtime = os.path.getmtime(path)
+		if current is not None and current.fname == fname and current.mtime == mtime:
+			return current
+		if fname is None:
+			# the file name stays the same when the artifact is replaced, its contents do not
+			version = '%s@%s' % (os.path.basename(path), file_digest(path)[:12])
+			# shipped artifacts are usually compressed, which rules out memory-mapping
+			model = joblib.load(path)
+		else:
+			version = os.path.splitext(fname)[0]
+			model = joblib.load(path, mmap_mode='r')
+		model = self.wrap(model)
+		logger.info('Loaded %s model %s', self.name, version)
+		return Loaded(fname, version, model, mtime)
+
+	def default_changed(self):
+		"""Whether the active model is the shipped artifact and its file has been replaced."""
+		if self.active.fname is not None:
+			return False
+		try:
+			return os.path.getmtime(self.default_path) != self.active.mtime
+		except OSError:
+			return False
+
+	def refresh(self):
+		"""Switch to the versions named in the deploy file if it changed. True if anything was swapped."""
+		try:
+			mtime = os.path.getmtime(self.deploy_fname)
+		except OSError:
+			mtime = None
+		if self.active is not None and mtime == self.deploy_mtime and not self.default_changed():
+			return False
+		deployment = self.read_deployment()
+		try:
+			active = self.load(deployment.get('active'), self.active)
+			canary = self.load(deployment['canary'], self.canary) if deployment.get('canary') else None
+		except Exception:
+			if self.active is None:
+				raise
+			logger.warning('Could not load the %s deployment, keeping %s', self.name, self.active.version, exc_info=True)
+			return False
+		swapped = self.active is not active or self.canary is not canary
+		self.active, self.canary = active, canary
+		self.canary_fraction = float(deployment.get('canary_fraction', 0.0)) if canary else 0.0
+		self.deploy_mtime = mtime
+		return swapped
+
+	def score_canary(self, texts):
+		"""Positive class probability of the canary for a random canary_fraction of texts, by index."""
+		if self.canary is None:
+			return {}
+		sample = [i for i in range(len(texts)) if random.random() < self.canary_fraction]
+		if not sample:
+			return {}
+		scores = self.canary.model.predict_proba([texts[i] for i in sample])[:, 1]
+		return {i: float(score) for i, score in zip(sample, scores)}
@@ -0,0 +1,136 @@
+"""Cache of classifier scores keyed by model version and text.
+
+Yelp reviews are upserted again every night with the same text and many tweets are copies of
+each other, so most texts have already been scored by the same model. Scores are looked up in
+an in-process LRU first and then in the score_cache collection, and only the misses (deduplicated
+within the batch) go through the model, vectorization included.
+
+A text is keyed on the tokens the model's own vectorizer splits it into, so texts differing only in
+what the vectorizer throws away (case, punctuation, whitespace, one-letter words) share an entry.
+n-grams, stop words and weights are all computed from those tokens, so equal tokens mean equal
+features and an equal score. Urls, mentions and an RT prefix leave tokens behind and are kept.
+Models that do not start with a word-level vectorizer are keyed on the exact text."""
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+import logging
+
+COLLECTION = 'score_cache'
+MAX_SIZE = 200000
+TTL_SECS = 30 * 24 * 3600
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(version, text):
+	return hashlib.sha1((version + u'\0' + text).encode('utf8')).hexdigest()
+
+
+def token_text(model):
+	"""A function turning a text into the tokens the model's vectorizer extracts from it, as one
+	string, or None when model is not a pipeline starting with a word-level sklearn vectorizer."""
+	steps = getattr(model, 'steps', None)
+	vectorizer = steps[0][1] if steps else None
+	if getattr(vectorizer, 'analyzer', None) != 'word' or not hasattr(vectorizer, 'build_tokenizer'):
+		return None
+	preprocess, tokenize = vectorizer.build_preprocessor(), vectorizer.build_tokenizer()
+	# length-prefixed, so no two token lists give the same string whatever the tokens contain
+	return lambda text: u''.join(u'%d:%s' % (len(token), token) for token in tokenize(preprocess(vectorizer.decode(text))))
+
+
+class ScoreCache(object):
+	def __init__(self, db=None, max_size=MAX_SIZE):
+		self.lock = threading.Lock()
+		self.memory = OrderedDict()
+		self.max_size = max_size
+		self.collection = db[COLLECTION] if db is not None else None
+		self.indexed = False
+		self.key_texts = {}
+		self.stats = {'memory_hits': 0, 'mongo_hits': 0, 'misses': 0}
+
+	def get_memory(self, key):
+		with self.lock:
+			if key not in self.memory:
+				return None
+			score = self.memory.pop(key)
+			self.memory[key] = score
+			return score
+
+	def put_memory(self, key, score):
+		with self.lock:
+			self.memory.pop(key, None)
+			self.memory[key] = score
+			while len(self.memory) > self.max_size:
+				self.memory.popitem(last=False)
+
+	def get_mongo(self, keys):
+		if self.collection is None or not keys:
+			return {}
+		try:
+			return {x['_id']: x['score'] for x in self.collection.find({'_id': {'$in': keys}}, {'score': 1})}
+		except PyMongoError:
+			logger.warning('Could not read the score cache', exc_info=True)
+			return {}
+
+	def put_mongo(self, scores):
+		if self.collection is None or not scores:
+			return
+		now = datetime.utcnow()
+		requests = [UpdateOne({'_id': key}, {'$set': {'score': score, 'created_at': now}}, upsert=True)
+					for key, score in scores.items()]
+		try:
+			if not self.indexed:
+				# entries expire, so the collection only holds recently seen texts
+				self.collection.create_index('created_at', expireAfterSeconds=TTL_SECS)
+				self.indexed = True
+			self.collection.bulk_write(requests, ordered=False)
+		except PyMongoError:
+			logger.warning('Could not write the score cache', exc_info=True)
+
+	def score(self, version, model, texts):
+		"""Positive class probability of every text, running model only on the ones not cached."""
+		if version not in self.key_texts:
+			self.key_texts[version] = token_text(model)
+		key_text = self.key_texts[version]
+		if key_text is None:
+			keys = [cache_key(version, text) for text in texts]
+		else:
+			# version names hold no NUL, so these keys never meet the exact-text ones
+			keys = [cache_key(version + u'\0tokens', key_text(text)) for text in texts]
+		scores = {}
+		for key in set(keys):
+			score = self.get_memory(key)
+			if score is not None:
+				scores[key] = score
+		self.stats['memory_hits'] += sum(1 for key in keys if key in scores)
+		missing = list(set(keys) - set(scores))
+		found = self.get_mongo(missing)
+		for key, score in found.items():
+			self.put_memory(key, score)
+		scores.update(found)
+		self.stats['mongo_hits'] += sum(1 for key in keys if key in found)
+
+		first_text = {}
+		for key, text in zip(keys, texts):
+			if key not in scores:
+				first_text.setdefault(key, text)
+		self.stats['misses'] += sum(1 for key in keys if key not in scores)
+		if first_text:
+			new_keys = list(first_text)
+			new_scores = model.predict_proba([first_text[key] for key in new_keys])[:, 1]
+			new_scores = dict(zip(new_keys, [float(x) for x in new_scores]))
+			for key, score in new_scores.items():
+				self.put_memory(key, score)
+			self.put_mongo(new_scores)
+			scores.update(new_scores)
+		return [scores[key] for key in keys]
+
+	def snapshot(self):
+		"""Hit counts and rates since the cache was created."""
+		total = sum(self.stats.values())
+		stats = dict(self.stats, total=total, size=len(self.memory))
+		stats['hit_rate'] = (self.stats['memory_hits'] + self.stats['mongo_hits']) / float(total) if total else 0.0
+		return stats
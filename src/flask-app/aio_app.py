@@ -0,0 +1,268 @@
+"""Asyncio serving mode for the API: the endpoints of app.py on aiohttp and Motor.
+
+	gunicorn -w 2 --bind 0.0.0.0:8080 aio_app:app -k aiohttp.GunicornWebWorker -c conf.py
+
+(docker-compose.async.yml switches the flask-app service to it). Mongo calls do not block the
+event loop and need no monkey-patching. The CPU-heavy part of a page (finishing tweets and
+serializing the JSON) runs on an executor, a thread pool by default or a process pool with
+ASYNC_CPU_EXECUTOR=process, while the loop goes on serving the other requests."""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime
+from aiohttp import web, BasicAuth
+from pymongo import UpdateOne
+import dbaccess
+import tweets
+import compression
+import export
+# importing app also registers its CommandTimer, before the Motor client is created
+from app import users, tojsonstream, INTERNAL_REVIEW_FIELDS, label_values, label_error
+from metrics import registry, RequestTimer
+
+CPU_EXECUTOR = os.environ.get('ASYNC_CPU_EXECUTOR', 'thread')
+CPU_WORKERS = int(os.environ.get('ASYNC_CPU_WORKERS', 2))
+UNAUTHORIZED = {'WWW-Authenticate': 'Basic realm="Authentication Required"'}
+
+
+def render_tweets(docs):
+	return ''.join(tojsonstream(map(tweets.finish_tweet, docs), tweets.dumps))
+
+
+def rename_id(obj):
+	obj["id"] = obj.pop("_id")
+	return obj
+
+
+def render_businesses(businesses, reviews):
+	"""The /new/businesses body and the acknowledgement records for the businesses in it."""
+	by_business = {}
+	for review in reviews:
+		by_business.setdefault(review.pop("business_id"), []).append(rename_id(review))
+	acks = []
+	for business in businesses:
+		business["reviews"] = by_business.get(business["_id"], [])
+		rename_id(business)
+		acks.append({"_id": business["id"], "time_updated": business["time_updated"],
+					 "review_ids": [review["id"] for review in business["reviews"]]})
+	return ''.join(tojsonstream(businesses, tweets.dumps)), acks
+
+
+async def run_cpu(request, fn, *args):
+	return await asyncio.get_event_loop().run_in_executor(request.app['executor'], fn, *args)
+
+
+async def stream(request, body):
+	"""Send body compressed as negotiated, one flush block at a time.
+
+	Blocks are compressed on the default thread pool (zlib and zstandard release the GIL while
+	they work), and each write waits until the transport has drained, so a slow client slows
+	the compression down instead of having its response buffered."""
+	encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+	response = web.StreamResponse(headers=compression.headers(encoding))
+	response.content_type = 'application/json'
+	await response.prepare(request)
+	size = compression.FLUSH_BYTES
+	blocks = compression.compress((body[i:i + size] for i in range(0, len(body), size)), encoding, size)
+	loop = asyncio.get_event_loop()
+	while True:
+		block = await loop.run_in_executor(None, next, blocks, None)
+		if block is None:
+			break
+		await response.write(block)
+	await response.write_eof()
+	return response
+
+
+def json_response(body, status=200):
+	return web.json_response(body, status=status, dumps=tweets.dumps)
+
+
+@web.middleware
+async def timed(request, handler):
+	request['timer'] = timer = RequestTimer(request.match_info.route.name or 'unmatched')
+	try:
+		return await handler(request)
+	finally:
+		timer.finish()
+
+
+@web.middleware
+async def basic_auth(request, handler):
+	try:
+		credentials = BasicAuth.decode(request.headers.get('Authorization', ''))
+	except ValueError:
+		credentials = None
+	if credentials is None or credentials.login not in users or users[credentials.login] != credentials.password:
+		return web.Response(status=401, text='Unauthorized Access', headers=UNAUTHORIZED)
+	return await handler(request)
+
+
+async def newyelp(request):
+	db, timer = request.app['db'], request['timer']
+	with timer.stage('pending'):
+		ids = [x["_id"] for x in await db.yelp_pending.find({}, {"_id":1}).limit(100).to_list(None)]
+		# yelp_feed only holds the ids; the reviews themselves are read once, here
+		feed_ids = [x["_id"] for x in await db.yelp_feed.find({"business_id": {"$in": ids}}, {"_id":1}).to_list(None)]
+		# a review is in the feed a moment before its classification is written; it waits for it
+		reviews = await db.reviews.find({"_id": {"$in": feed_ids}, "classification": {"$exists": True}},
+										INTERNAL_REVIEW_FIELDS).to_list(None)
+		businesses = await db.businesses.find({"_id": {"$in": ids}}, {"acknowledged":0}).to_list(None)
+		found = set(business["_id"] for business in businesses)
+		orphans = [x for x in ids if x not in found]
+		if orphans:
+			await db.yelp_pending.delete_many({"_id": {"$in": orphans}})
+	with timer.stage('serialize'):
+		body, acks = await run_cpu(request, render_businesses, businesses, reviews)
+	with timer.stage('ack'):
+		if acks:
+			await db.yelp_ack.bulk_write([UpdateOne({"_id": ack["_id"]}, {"$set": ack}, upsert=True) for ack in acks],
+										 ordered=False)
+	return await stream(request, body)
+
+
+async def newtweets(request):
+	db, timer = request.app['db'], request['timer']
+	with timer.stage('aggregate'):
+		docs = await db.tweets.aggregate(tweets.pipeline()).to_list(None)
+	with timer.stage('process'):
+		body = await run_cpu(request, render_tweets, docs)
+	return await stream(request, body)
+
+
+async def exported(request, name, columns, export_format, cursor, finish):
+	"""Send an export of the documents of a Motor cursor, one batch at a time.
+
+	Batches are encoded and compressed on the default thread pool, and each write waits for
+	the client, so only one batch is in memory at a time."""
+	encoding = None
+	if export_format in export.STREAM_COMPRESSED:
+		encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+	headers = compression.headers(encoding)
+	headers['Content-Disposition'] = 'attachment; filename="%s.%s"' % (name, export_format)
+	response = web.StreamResponse(headers=headers)
+	response.content_type = export.CONTENT_TYPES[export_format]
+	await response.prepare(request)
+	encoder = export.encoder(columns, export_format)
+	send, end = compression.block_compressor(encoding)
+	loop = asyncio.get_event_loop()
+
+	async def write(encode):
+		data = await loop.run_in_executor(None, encode)
+		if data:
+			await response.write(data)
+
+	await write(lambda: send(encoder.start()))
+	while True:
+		with request['timer'].stage('read'):
+			docs = await cursor.to_list(export.BATCH_ROWS)
+		if not docs:
+			break
+		await write(lambda: send(encoder.batch([finish(x) for x in docs])))
+	await write(lambda: send(encoder.end()) + end())
+	await response.write_eof()
+	return response
+
+
+async def exporttweets(request):
+	try:
+		since, until, after, export_format = export.parse_request(request.query)
+		pipeline = export.tweet_pipeline(since, until, after)
+	except export.ExportError as e:
+		return json_response({"message":str(e)}, 400)
+	cursor = request.app['db'].tweets.aggregate(pipeline, batchSize=export.BATCH_ROWS)
+	return await exported(request, 'tweets', export.TWEET_COLUMNS, export_format, cursor, tweets.finish_tweet)
+
+
+async def exportreviews(request):
+	try:
+		since, until, after, export_format = export.parse_request(request.query)
+	except export.ExportError as e:
+		return json_response({"message":str(e)}, 400)
+	query = export.review_query(since, until, after)
+	cursor = request.app['db'].reviews.find(query, INTERNAL_REVIEW_FIELDS).sort('_id', 1).batch_size(export.BATCH_ROWS)
+	return await exported(request, 'reviews', export.REVIEW_COLUMNS, export_format, cursor, export.finish_review)
+
+
+async def ackbusiness(request):
+	db, id = request.app['db'], request.match_info['id']
+	ack_record = await db.yelp_ack.find_one_and_delete({"_id":id})
+	if not ack_record:
+		return json_response({"message":"There is nothing to acknowldge for the requested business id"}, 404)
+	await db.businesses.update_one({"_id":id}, {"$set": {"acknowledged":ack_record["time_updated"]}})
+	await db.reviews.update_many({"_id":{"$in": ack_record["review_ids"]}}, {"$set": {"acknowledged":True}})
+	await db.yelp_feed.delete_many({"_id":{"$in": ack_record["review_ids"]}})
+	await db.yelp_pending.update_one({"_id":id}, {"$pull": {"review_ids": {"$in": ack_record["review_ids"]}}})
+	await db.yelp_pending.delete_one({"_id":id, "review_ids": {"$size": 0}, "time_updated": {"$in": [ack_record["time_updated"], None]}})
+	return json_response({"message":"Success"})
+
+
+async def acktweet(request):
+	update_result = await request.app['db'].tweets.update_one({"_id":int(request.match_info['id'])},
+															  {"$set": {"acknowledged":True}})
+	if update_result.matched_count==0:
+		return json_response({"message":"Tweet not found"}, 404)
+	return json_response({"message":"Success"})
+
+
+async def label(request, collection, id):
+	try:
+		body = await request.json()
+	except ValueError:
+		body = None
+	record = label_values(collection, body)
+	if not record:
+		return json_response(label_error(collection), 400)
+	record = {"label." + name: value for name, value in record.items()}
+	record["label.labeled_at"] = datetime.utcnow()
+	update_result = await request.app['db'][collection].update_one({"_id":id}, {"$set": record})
+	if update_result.matched_count==0:
+		return json_response({"message":"Not found"}, 404)
+	return json_response({"message":"Success"})
+
+
+async def labelreview(request):
+	return await label(request, 'reviews', request.match_info['id'])
+
+
+async def labeltweet(request):
+	return await label(request, 'tweets', int(request.match_info['id']))
+
+
+async def metrics(request):
+	return json_response({**registry.snapshot(), 'pool': dbaccess.pool_stats.snapshot()})
+
+
+async def open_resources(app):
+	app['db'] = dbaccess.get_async_db()
+	if CPU_EXECUTOR == 'process':
+		app['executor'] = ProcessPoolExecutor(CPU_WORKERS)
+	else:
+		app['executor'] = ThreadPoolExecutor(CPU_WORKERS)
+
+
+async def close_resources(app):
+	app['db'].client.close()
+	app['executor'].shutdown(wait=False)
+
+
+def make_app():
+	app = web.Application(middlewares=[timed, basic_auth])
+	app.router.add_get('/new/businesses', newyelp, name='newyelp')
+	app.router.add_get('/new/tweets', newtweets, name='newtweets')
+	app.router.add_get('/export/tweets', exporttweets, name='exporttweets')
+	app.router.add_get('/export/reviews', exportreviews, name='exportreviews')
+	app.router.add_post('/ack/business/{id}', ackbusiness, name='ackbusiness')
+	app.router.add_post(r'/ack/tweet/{id:\d+}', acktweet, name='acktweet')
+	app.router.add_post('/label/review/{id}', labelreview, name='labelreview')
+	app.router.add_post(r'/label/tweet/{id:\d+}', labeltweet, name='labeltweet')
+	app.router.add_get('/metrics', metrics, name='metrics')
+	app.on_startup.append(open_resources)
+	app.on_cleanup.append(close_resources)
+	return app
+
+
+app = make_app()
+
+if __name__ == '__main__':
+	web.run_app(app, port=8080)
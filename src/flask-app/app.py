@@ -1,15 +1,24 @@
 from flask import Flask
 from flask import Response 
 from flask import jsonify
+from flask import request
+from flask import g
 from flask_httpauth import HTTPBasicAuth
 from bson import json_util
-from pymongo import MongoClient
-import re
-
-client = MongoClient('mongodb://mongo:27017/')
-db = client.fdbnyc
+from dbaccess import lazy_db, add_listener, pool_stats
+from metrics import registry, RequestTimer, CommandTimer
+import os
+import tweets
+import compression
+import export
+from batching import make_batches
+from datetime import datetime
+
+add_listener(CommandTimer())
+db = lazy_db
 
 app = Flask(__name__)
+app.config['PROFILE_REQUESTS'] = os.environ.get('PROFILE_REQUESTS') == '1'
 auth = HTTPBasicAuth()
 
 users = {
@@ -22,34 +31,73 @@ def get_pw(username):
         return users.get(username)
     return None
 
-def tojsonstream(x):
+def tojsonstream(x, dumps=json_util.dumps):
 	yield '['
 	for i, item in enumerate(x):
 		if i==0:
-			yield json_util.dumps(item)
+			yield dumps(item)
 		else:
-			yield ','+json_util.dumps(item)
+			yield ','+dumps(item)
 	yield ']'
 
 
+def streamed(items, dumps):
+	"""A JSON array response of items, compressed as negotiated and flushed in blocks."""
+	encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+	return Response(compression.compress(tojsonstream(items, dumps), encoding),
+					mimetype='application/json', headers=compression.headers(encoding))
+
+
+def profiling_requested():
+	return app.config['PROFILE_REQUESTS'] and request.args.get('profile') == '1'
+
+@app.before_request
+def start_timer():
+	g.timer = RequestTimer(request.endpoint or 'unmatched')
+	if profiling_requested():
+		from pyinstrument import Profiler
+		g.profiler = Profiler(interval=0.001)
+		g.profiler.start()
+
+@app.after_request
+def stop_timer(response):
+	if 'profiler' in g:
+		if response.status_code >= 400:
+			# failed requests, unauthenticated ones included, get their own response and no profile
+			g.profiler.stop()
+		else:
+			# consume the streamed body while sampling so the generator stages are included
+			response.get_data()
+			g.profiler.stop()
+			return Response(g.profiler.output_text(unicode=True), mimetype='text/plain')
+	response.call_on_close(g.timer.finish)
+	return response
+
+
+
+INTERNAL_REVIEW_FIELDS = {"ingested_at":0, "classified_at":0, "freshness_secs":0, "acknowledged":0, "label":0, "bucket":0}
 
 @app.route('/new/businesses')
 @auth.login_required
 def newyelp():
-
-	def lookup():
-		return {"$lookup" : { "from" :"yelp_feed", "localField":"_id", "foreignField": "business_id", "as": "reviews"}}
-
-	def keep_new():
-		condition_review={"$ne" : [ "$reviews" , [] ]}
-		condition_ack ={"$ne": ["$time_updated", "$acknowledged"]}
-		condition = {"$or": [condition_review,condition_ack ]}
-		if_else = {"if": condition , "then": "$$KEEP", "else": "$$PRUNE"}
-		return {"$redact": {"$cond": if_else}}
-	
-	def project():
-		fields={"reviews.business_id":0 , "acknowledged":0 }
-		return {"$project":fields}
+	timer = g.timer
+
+	def pending_businesses():
+		ids=[x["_id"] for x in db.yelp_pending.find({}, {"_id":1}).limit(100)]
+		reviews={}
+		# yelp_feed only holds the ids; the reviews themselves are read once, here
+		feed_ids=[x["_id"] for x in db.yelp_feed.find({"business_id": {"$in": ids}}, {"_id":1})]
+		# a review is in the feed a moment before its classification is written; it waits for it
+		for review in db.reviews.find({"_id": {"$in": feed_ids}, "classification": {"$exists": True}}, INTERNAL_REVIEW_FIELDS):
+			reviews.setdefault(review.pop("business_id"), []).append(review)
+		found=set()
+		for business in db.businesses.find({"_id": {"$in": ids}}, {"acknowledged":0}):
+			found.add(business["_id"])
+			business["reviews"]=reviews.get(business["_id"], [])
+			yield business
+		orphans=[x for x in ids if x not in found]
+		if orphans:
+			db.yelp_pending.delete_many({"_id": {"$in": orphans}})
 	
 	def change_id(business):
 		def rename_id(obj):
@@ -69,84 +117,51 @@ def newyelp():
 		return business
 	
 	
-	pipeline=[lookup(), keep_new(), project(), {"$limit": 100}]
-	businesses = db.businesses.aggregate(pipeline)
-	businesses_proj=map(change_id,businesses)
-	businesses_ack= map(acknowldege_record,businesses_proj)
-	return Response(
-   		tojsonstream(businesses_ack),
-   		mimetype='application/json'
-	)
+	businesses = timer.iterate('pending', pending_businesses())
+	businesses_proj=map(timer.wrap('change_id', change_id),businesses)
+	businesses_ack= map(timer.wrap('ack', acknowldege_record),businesses_proj)
+	return streamed(businesses_ack, timer.wrap('serialize', json_util.dumps))
 
 @app.route('/new/tweets')
 @auth.login_required
 def newtweets():
-
-	def user_mention():
-		return {
-			'id':'$$mention.id_str',
-			'name': '$$mention.name',
-			'location':None,
-			'screenName':'$$mention.screen_name',
-			'is_nyc':None 
-		}
-
-	def project_tweet(top=""):
-		return {
-			'id':f'${top}id_str',
-			'createdDate':f'${top}created_at',
-			'text':f'${top}full_text',
-			'source':f'${top}tweet_source',
-			'lattitude': { "$arrayElemAt": [ f"${top}coordinates.coordinates", 1 ]},
-			'longitude': { "$arrayElemAt": [ f"${top}coordinates.coordinates", 0 ]},
-			'hashtags' :{"$map":{ "input":f'${top}entities.hashtags', "as": "hashtag","in": "$$hashtag.text" }},
-			'symbols': {"$map":{ "input":f'${top}entities.symbols', "as": "symbol","in": "$$symbol.text" }},
-			'urls': {"$map":{ "input":f'${top}entities.urls', "as": "url","in": "$$url.expanded_url" }},
-			'user':{'id': f'${top}user.id_str','name': f'${top}user.name','screenName':f'${top}user.screen_name', 
-					'location':f'${top}user.location'},
-			'inReplytoTweetId':f'${top}in_reply_to_status_id_str',
-			'userMentions': { "$map": { "input": f'${top}entities.user_mentions', "as": "mention", "in": user_mention()}},
-		}
-	
-	def projection():
-		return {**project_tweet(), **{'serializedFoursquareCheckin':None,
-				'foursquareCheckinAttemptedDate':None,
-				'timelineExpansionAttemptedDate':{ "$dateToString": { "format":"%Y-%m-%d %H:%M:%S:%L", "date": "$timelineExpansionAttemptedDate" } },
-				'conversationTrackingAttemptedDate':{ "$dateToString": { "format":"%Y-%m-%d %H:%M:%S:%L", "date": "$conversationTrackingAttemptedDate" } },
-				'classification':1,
-				'relatedTweets': {"$map": {"input": "$relatedTweets", "as": "tweet", "in": project_tweet("$tweet.") }},
-				'_id':0}}
-
-	def is_nyc(user):
-		locations=['Brooklyn','Hoboken','NY','Manhattan','New York','Bronx','Queens','Long Island','Staten Island']
-		user_location=user['location']
-		return any([re.search(x, user_location) for x in locations])
-	
-	def process_tweet(tweet):
-		user=tweet['user']
-		user['is_nyc']=is_nyc(user)
-		tweet['serializedHashtags']=json_util.dumps(tweet['hashtags'])
-		del tweet['hashtags']
-		tweet['serializedSymbols']=json_util.dumps(tweet['symbols'])
-		del tweet['symbols']
-		tweet['serializedUrls']=json_util.dumps(tweet['urls'])
-		del tweet['urls']
-		if 'relatedTweets' in tweet and tweet['relatedTweets']: 
-			tweet['serialized_data']=json_util.dumps([process_tweet(x) for x in tweet['relatedTweets']])
-			del tweet['relatedTweets']
-		elif 'relatedTweets' in tweet:
-			tweet['serialized_data']=json_util.dumps([])
-			del tweet['relatedTweets']
-		return tweet
-	
-	query={"acknowledged" : { "$exists" : False }, "classification" : { "$exists" : True }, 
-							'timelineExpansionAttemptedDate': { "$exists" : True }, 'conversationTrackingAttemptedDate': { "$exists" : True } }
-	pipeline=[{"$match": query},{"$project": projection()},{"$limit": 100}]
-	items = map(process_tweet, db.tweets.aggregate(pipeline))
-	return Response(
-    	tojsonstream(items),
-    	mimetype='application/json'
-	)
+	timer = g.timer
+	items = map(timer.wrap('process', tweets.finish_tweet), timer.iterate('aggregate', db.tweets.aggregate(tweets.pipeline())))
+	return streamed(items, timer.wrap('serialize', tweets.dumps))
+
+def exported(name, columns, export_format, docs):
+	"""An export response of docs, sent and compressed as negotiated one batch at a time."""
+	encoding = None
+	if export_format in export.STREAM_COMPRESSED:
+		encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+	headers = compression.headers(encoding)
+	headers['Content-Disposition'] = 'attachment; filename="%s.%s"' % (name, export_format)
+	body = export.encode(make_batches(export.BATCH_ROWS, docs), export.encoder(columns, export_format))
+	return Response(compression.compress(body, encoding), mimetype=export.CONTENT_TYPES[export_format], headers=headers)
+
+@app.route('/export/tweets')
+@auth.login_required
+def exporttweets():
+	try:
+		since, until, after, export_format = export.parse_request(request.args)
+		pipeline = export.tweet_pipeline(since, until, after)
+	except export.ExportError as e:
+		return jsonify({"message":str(e)}), 400
+	cursor = db.tweets.aggregate(pipeline, batchSize=export.BATCH_ROWS)
+	docs = map(tweets.finish_tweet, g.timer.iterate('aggregate', cursor))
+	return exported('tweets', export.TWEET_COLUMNS, export_format, docs)
+
+@app.route('/export/reviews')
+@auth.login_required
+def exportreviews():
+	try:
+		since, until, after, export_format = export.parse_request(request.args)
+	except export.ExportError as e:
+		return jsonify({"message":str(e)}), 400
+	query = export.review_query(since, until, after)
+	cursor = db.reviews.find(query, INTERNAL_REVIEW_FIELDS).sort('_id', 1).batch_size(export.BATCH_ROWS)
+	docs = map(export.finish_review, g.timer.iterate('find', cursor))
+	return exported('reviews', export.REVIEW_COLUMNS, export_format, docs)
 
 @app.route('/ack/business/<id>', methods=['POST'])
 @auth.login_required
@@ -157,6 +172,8 @@ def ackbusiness(id):
 	db.businesses.update_one({"_id":id}, {"$set": {"acknowledged":ack_record["time_updated"]}} )
 	db.reviews.update_many({"_id":{"$in": ack_record["review_ids"]}},{"$set": {"acknowledged":True}})
 	db.yelp_feed.delete_many({"_id":{"$in": ack_record["review_ids"]}})
+	db.yelp_pending.update_one({"_id":id}, {"$pull": {"review_ids": {"$in": ack_record["review_ids"]}}})
+	db.yelp_pending.delete_one({"_id":id, "review_ids": {"$size": 0}, "time_updated": {"$in": [ack_record["time_updated"], None]}})
 	return jsonify({"message":"Success"})
 
 
@@ -168,5 +185,51 @@ def acktweet(id):
 		return jsonify({"message":"Tweet not found"}),404
 	return jsonify({"message":"Success"})
 
+LABELS = {'reviews': ('is_foodborne', 'is_multiple'), 'tweets': ('is_foodborne',)}
+
+def label_values(collection, body):
+	"""The labels posted in body as 0/1, or None unless there is one and each is a JSON boolean or 0/1."""
+	if not isinstance(body, dict):
+		return None
+	record = {}
+	for name in LABELS[collection]:
+		if name not in body:
+			continue
+		value = body[name]
+		# strings such as "false" or "0" are rejected rather than read as truthy
+		if not (isinstance(value, bool) or (isinstance(value, int) and value in (0, 1))):
+			return None
+		record[name] = int(value)
+	return record or None
+
+def label_error(collection):
+	return {"message":"Expected a JSON body with any of " + ", ".join(LABELS[collection]) + ", each true/false or 1/0"}
+
+def label(collection, id):
+	record = label_values(collection, request.get_json(silent=True))
+	if not record:
+		return jsonify(label_error(collection)), 400
+	record = {"label." + name: value for name, value in record.items()}
+	record["label.labeled_at"] = datetime.utcnow()
+	update_result = db[collection].update_one({"_id":id}, {"$set": record})
+	if update_result.matched_count==0:
+		return jsonify({"message":"Not found"}),404
+	return jsonify({"message":"Success"})
+
+@app.route('/label/review/<id>', methods=['POST'])
+@auth.login_required
+def labelreview(id):
+	return label('reviews', id)
+
+@app.route('/label/tweet/<int:id>', methods=['POST'])
+@auth.login_required
+def labeltweet(id):
+	return label('tweets', id)
+
+@app.route('/metrics')
+@auth.login_required
+def metrics():
+	return jsonify({**registry.snapshot(), 'pool': pool_stats.snapshot()})
+
 if __name__ == '__main__':
 	app.run()
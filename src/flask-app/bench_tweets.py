@@ -0,0 +1,127 @@
+"""CPU spent in Python per /new/tweets page, before and after the reshaping moved into the pipeline.
+
+	docker-compose run --rm flask-app python bench_tweets.py [--pages 200] [--related 20]
+
+Builds a page of synthetic tweets as each version of the pipeline returns them, then times the
+per-tweet processing and the JSON serialization of the whole page with time.process_time, and
+checks that both versions produce the same JSON."""
+import argparse
+import json
+import random
+import re
+import time
+from copy import deepcopy
+from statistics import median
+from bson import json_util
+import tweets
+
+LOCATIONS = ['Brooklyn, NY', 'Hoboken', 'Paris', 'New York City', '', 'Queens', 'Austin, TX', 'somewhere']
+
+
+def legacy_process_tweet(tweet):
+	"""process_tweet as it was before the pipeline produced the response field names."""
+	def is_nyc(user):
+		locations=['Brooklyn','Hoboken','NY','Manhattan','New York','Bronx','Queens','Long Island','Staten Island']
+		user_location=user['location']
+		return any([re.search(x, user_location) for x in locations])
+
+	user=tweet['user']
+	user['is_nyc']=is_nyc(user)
+	tweet['serializedHashtags']=json_util.dumps(tweet['hashtags'])
+	del tweet['hashtags']
+	tweet['serializedSymbols']=json_util.dumps(tweet['symbols'])
+	del tweet['symbols']
+	tweet['serializedUrls']=json_util.dumps(tweet['urls'])
+	del tweet['urls']
+	if 'relatedTweets' in tweet and tweet['relatedTweets']:
+		tweet['serialized_data']=json_util.dumps([legacy_process_tweet(x) for x in tweet['relatedTweets']])
+		del tweet['relatedTweets']
+	elif 'relatedTweets' in tweet:
+		tweet['serialized_data']=json_util.dumps([])
+		del tweet['relatedTweets']
+	return tweet
+
+
+def fake_tweet(rs, i):
+	words = ['sick', 'food', 'nyc', 'pizza', 'tummy', 'brunch']
+	return {
+		'id': str(10**17 + i),
+		'createdDate': 'Mon Oct 19 12:00:00 +0000 2026',
+		'text': ' '.join(rs.choice(words) for _ in range(20)),
+		'source': 'Twitter for iPhone',
+		'lattitude': 40.7 + rs.random(), 'longitude': -74.0 + rs.random(),
+		'hashtags': [rs.choice(words) for _ in range(rs.randint(0, 4))],
+		'symbols': [],
+		'urls': ['https://example.com/%d' % rs.randint(0, 10**6) for _ in range(rs.randint(0, 2))],
+		'user': {'id': str(rs.randint(0, 10**9)), 'name': 'someone', 'screenName': 'someone',
+				 'location': rs.choice(LOCATIONS)},
+		'inReplytoTweetId': None,
+		'userMentions': [{'id': '1', 'name': 'a', 'location': None, 'screenName': 'a', 'is_nyc': None}],
+	}
+
+
+def legacy_page(rs, n, related):
+	page = []
+	for i in range(n):
+		tweet = fake_tweet(rs, i)
+		tweet.update({'serializedFoursquareCheckin': None, 'foursquareCheckinAttemptedDate': None,
+					  'timelineExpansionAttemptedDate': '2026-10-19 12:00:00:000',
+					  'conversationTrackingAttemptedDate': '2026-10-19 12:00:00:000',
+					  'classification': {'total_score': rs.random(), 'model_version': 'v1'},
+					  'relatedTweets': [fake_tweet(rs, n + i * related + j) for j in range(rs.randint(0, related))]})
+		page.append(tweet)
+	return page
+
+
+def rename(tweet):
+	"""The same tweet with the names the new pipeline projects it to."""
+	tweet = dict(tweet)
+	for old, new in [('hashtags', 'serializedHashtags'), ('symbols', 'serializedSymbols'), ('urls', 'serializedUrls')]:
+		tweet[new] = tweet.pop(old)
+	if 'relatedTweets' in tweet:
+		tweet['serialized_data'] = [rename(x) for x in tweet.pop('relatedTweets')]
+	return tweet
+
+
+def render(page, process, dumps):
+	return '[' + ','.join(dumps(process(tweet)) for tweet in page) + ']'
+
+
+def cpu_per_page(page, process, dumps, pages):
+	times = []
+	for _ in range(pages):
+		# the copy stands in for decoding the aggregate's cursor and is not timed
+		fresh = deepcopy(page)
+		t0 = time.process_time()
+		render(fresh, process, dumps)
+		times.append(time.process_time() - t0)
+	return times
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--pages', type=int, default=200)
+	parser.add_argument('--page-size', type=int, default=tweets.PAGE_SIZE)
+	parser.add_argument('--related', type=int, default=20, help='at most this many related tweets per tweet')
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+
+	old_page = legacy_page(random.Random(args.seed), args.page_size, args.related)
+	new_page = [rename(x) for x in old_page]
+	old_json = render(deepcopy(old_page), legacy_process_tweet, json_util.dumps)
+	new_json = render(deepcopy(new_page), tweets.finish_tweet, tweets.dumps)
+	assert json.loads(old_json) == json.loads(new_json), 'the two versions disagree'
+
+	n_related = sum(len(x['relatedTweets']) for x in old_page)
+	print('%d tweets and %d related tweets per page, %d bytes of JSON' % (len(old_page), n_related, len(new_json)))
+	results = {}
+	for name, page, process, dumps in [('before', old_page, legacy_process_tweet, json_util.dumps),
+									   ('after', new_page, tweets.finish_tweet, tweets.dumps)]:
+		times = cpu_per_page(page, process, dumps, args.pages)
+		results[name] = median(times)
+		print('%-6s  median %7.2f ms  min %7.2f ms  CPU per page' % (name, 1000 * results[name], 1000 * min(times)))
+	print('speedup %.1fx' % (results['before'] / results['after']))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,100 @@
+"""Content-Encoding negotiation and streaming compression for the /new/* responses.
+
+The JSON items of a response are coalesced into blocks of about STREAM_FLUSH_BYTES characters,
+and each block is compressed and flushed to the client as soon as it is complete, so the client
+can start decompressing while the rest of the page is still being read from Mongo. Blocks are
+only produced when the server asks for the next one, i.e. once the previous one has been written
+to the client, so a slow reader holds back the producer instead of making the response pile up
+in memory. zstd is offered when the zstandard package is installed."""
+import os
+import zlib
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+FLUSH_BYTES = int(os.environ.get('STREAM_FLUSH_BYTES', 64 * 1024))
+GZIP_LEVEL = int(os.environ.get('STREAM_GZIP_LEVEL', 6))
+ZSTD_LEVEL = int(os.environ.get('STREAM_ZSTD_LEVEL', 3))
+# in order of preference when the client accepts several equally
+ENCODINGS = [x for x in os.environ.get('STREAM_ENCODINGS', 'zstd,gzip').split(',')
+			 if x == 'gzip' or (x == 'zstd' and zstandard is not None)]
+
+
+def negotiate(accept_encoding, encodings=ENCODINGS):
+	"""The encoding to use for a request's Accept-Encoding header, or None to send it uncompressed."""
+	accepted = {}
+	for part in (accept_encoding or '').split(','):
+		name, _, params = part.partition(';')
+		params = params.strip().replace(' ', '')
+		try:
+			q = float(params[2:]) if params.startswith('q=') else 1.0
+		except ValueError:
+			q = 0.0
+		accepted[name.strip().lower()] = q
+	best, best_q = None, 0.0
+	for encoding in encodings:
+		q = accepted.get(encoding, accepted.get('*', 0.0))
+		if q > best_q:
+			best, best_q = encoding, q
+	return best
+
+
+def headers(encoding):
+	if encoding is None:
+		return {'Vary': 'Accept-Encoding'}
+	return {'Vary': 'Accept-Encoding', 'Content-Encoding': encoding}
+
+
+def join(buffer):
+	return ''.join(buffer).encode('utf8') if isinstance(buffer[0], str) else b''.join(buffer)
+
+
+def coalesce(chunks, flush_bytes=FLUSH_BYTES):
+	"""Join small chunks (all str, sent as utf8, or all bytes) into blocks of at least flush_bytes
+	characters (except the last)."""
+	buffer, size = [], 0
+	for chunk in chunks:
+		buffer.append(chunk)
+		size += len(chunk)
+		if size >= flush_bytes:
+			yield join(buffer)
+			buffer, size = [], 0
+	if buffer:
+		yield join(buffer)
+
+
+def compressor(encoding):
+	"""A function compressing one block and flushing it, and one ending the stream."""
+	if encoding == 'gzip':
+		c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		return (lambda block: c.compress(block) + c.flush(zlib.Z_SYNC_FLUSH)), c.flush
+	if encoding == 'zstd':
+		c = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+		return (lambda block: c.compress(block) + c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)), c.flush
+	raise ValueError('Unsupported encoding %r' % encoding)
+
+
+def block_compressor(encoding):
+	"""Like compressor, for blocks that can be str (sent as utf8) or bytes, and for no encoding too."""
+	if encoding is None:
+		return join_one, bytes
+	send, end = compressor(encoding)
+	return (lambda block: send(join_one(block))), end
+
+
+def join_one(block):
+	return join([block])
+
+
+def compress(chunks, encoding, flush_bytes=FLUSH_BYTES):
+	"""The body for chunks in encoding (None for none), as bytes blocks of about flush_bytes."""
+	if encoding is None:
+		yield from coalesce(chunks, flush_bytes)
+		return
+	send, end = compressor(encoding)
+	for block in coalesce(chunks, flush_bytes):
+		data = send(block)
+		if data:
+			yield data
+	yield end()
@@ -1,8 +1,28 @@
-from pymongo import MongoClient
+from datetime import datetime
+import dbaccess
+
+
+def backfill_yelp_pending(db):
+    # one-off migration for databases created before yelp_pending was maintained by the yelp services
+    lookup = {"$lookup": {"from": "yelp_feed", "localField": "_id", "foreignField": "business_id", "as": "reviews"}}
+    condition = {"$or": [{"$ne": ["$reviews", []]}, {"$ne": ["$time_updated", "$acknowledged"]}]}
+    keep_new = {"$redact": {"$cond": {"if": condition, "then": "$$KEEP", "else": "$$PRUNE"}}}
+    project = {"$project": {"time_updated": 1, "acknowledged": 1, "reviews._id": 1}}
+    for business in db.businesses.aggregate([lookup, keep_new, project], allowDiskUse=True):
+        record = {"review_ids": [review["_id"] for review in business["reviews"]]}
+        if business.get("time_updated") != business.get("acknowledged"):
+            record["time_updated"] = business["time_updated"]
+        db.yelp_pending.update_one({"_id": business["_id"]}, {"$set": record}, upsert=True)
 
 
 def on_starting(server):
-    client = MongoClient('mongodb://mongo:27017/')
-    db = client.fdbnyc
+    db = dbaccess.get_db()
     db.yelp_ack.drop()
-    db.yelp_feed.create_index("business_id",background=True)
\ No newline at end of file
+    db.yelp_feed.create_index("business_id",background=True)
+    # the yelp services upsert into yelp_pending as well, so whether it exists says nothing
+    # about whether the migration ran; a record in migrations does
+    if not db.migrations.find_one({"_id": "backfill_yelp_pending"}):
+        backfill_yelp_pending(db)
+        db.migrations.update_one({"_id": "backfill_yelp_pending"}, {"$set": {"applied_at": datetime.utcnow()}}, upsert=True)
+    # the master must not hand its client to the forked workers
+    dbaccess.close()
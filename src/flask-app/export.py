@@ -0,0 +1,201 @@
+"""Read-only bulk export of tweets and reviews for offline analysis.
+
+/export/tweets and /export/reviews stream every document whose collected_at / ingested_at lies
+in [since, until), in _id order, with the projections of /new/tweets and /new/businesses. The
+formats are NDJSON (one record per line, as the /new/* endpoints return them), an Arrow IPC
+stream or a Parquet file. The two binary formats have the fixed columns in TWEET_COLUMNS and
+REVIEW_COLUMNS: nested values are flattened into dotted column names or stored as JSON strings.
+Documents are read, encoded and sent EXPORT_BATCH_ROWS at a time, so the server's memory does
+not grow with the range. An interrupted export is resumed by passing the id of the last record
+received as after=, and the new response starts with the record that follows it.
+
+Nothing is acknowledged or otherwise written."""
+import os
+from datetime import datetime
+import tweets
+try:
+	import pyarrow
+	import pyarrow.parquet
+except ImportError:
+	pyarrow = None
+
+BATCH_ROWS = int(os.environ.get('EXPORT_BATCH_ROWS', 5000))
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f')
+CONTENT_TYPES = {'ndjson': 'application/x-ndjson',
+				 'arrow': 'application/vnd.apache.arrow.stream',
+				 'parquet': 'application/vnd.apache.parquet'}
+# parquet compresses its pages itself and is not worth compressing again
+STREAM_COMPRESSED = ('ndjson', 'arrow')
+
+TWEET_COLUMNS = [('id', 'string'), ('createdDate', 'string'), ('text', 'string'), ('source', 'string'),
+				 ('lattitude', 'float64'), ('longitude', 'float64'),
+				 ('serializedHashtags', 'string'), ('serializedSymbols', 'string'), ('serializedUrls', 'string'),
+				 ('user.id', 'string'), ('user.name', 'string'), ('user.screenName', 'string'),
+				 ('user.location', 'string'), ('user.is_nyc', 'bool'), ('inReplytoTweetId', 'string'),
+				 ('userMentions', 'string'), ('timelineExpansionAttemptedDate', 'string'),
+				 ('conversationTrackingAttemptedDate', 'string'), ('classification.total_score', 'float64'),
+				 ('classification', 'string'), ('serialized_data', 'string')]
+REVIEW_COLUMNS = [('id', 'string'), ('business_id', 'string'), ('text', 'string'), ('rating', 'float64'),
+				  ('time_created', 'string'), ('url', 'string'), ('user.id', 'string'), ('user.name', 'string'),
+				  ('classification.total_score', 'float64'), ('classification', 'string')]
+
+
+class ExportError(ValueError):
+	pass
+
+
+def parse_date(text):
+	if not text:
+		return None
+	for date_format in DATE_FORMATS:
+		try:
+			return datetime.strptime(text, date_format)
+		except ValueError:
+			pass
+	raise ExportError('Dates look like 2018-01-31 or 2018-01-31T12:00:00, not %r' % text)
+
+
+def date_range(field, since, until):
+	query = {}
+	if since is not None:
+		query['$gte'] = since
+	if until is not None:
+		query['$lt'] = until
+	return {field: query} if query else {}
+
+
+def tweet_pipeline(since=None, until=None, after=None):
+	"""Aggregation of the tweets collected in [since, until) with an _id after after, as on /new/tweets."""
+	match = date_range('collected_at', since, until)
+	if after is not None:
+		try:
+			match['_id'] = {'$gt': int(after)}
+		except ValueError:
+			raise ExportError('after is the id of a tweet, not %r' % after)
+	# sorting on _id walks its index instead of sorting in memory
+	return [{"$match": match}, {"$sort": {"_id": 1}}, {"$project": tweets.projection()}]
+
+
+def review_query(since=None, until=None, after=None):
+	"""Filter of the reviews ingested in [since, until) with an _id after after."""
+	match = date_range('ingested_at', since, until)
+	if after is not None:
+		match['_id'] = {'$gt': after}
+	return match
+
+
+def finish_review(review):
+	review["id"] = review.pop("_id")
+	return review
+
+
+def parse_request(args):
+	"""since, until and after of an export request's query string, and its format."""
+	export_format = args.get('format', 'ndjson')
+	if export_format not in CONTENT_TYPES:
+		raise ExportError('format is one of ' + ', '.join(sorted(CONTENT_TYPES)))
+	if export_format != 'ndjson' and pyarrow is None:
+		raise ExportError('pyarrow is not installed, only format=ndjson is available')
+	return parse_date(args.get('since')), parse_date(args.get('until')), args.get('after') or None, export_format
+
+
+def column_value(doc, path, kind):
+	value = doc
+	for key in path.split('.'):
+		if not isinstance(value, dict):
+			return None
+		value = value.get(key)
+	if value is None:
+		return None
+	if kind == 'string':
+		return value if isinstance(value, str) else tweets.dumps(value)
+	if kind == 'float64':
+		return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+	return bool(value)
+
+
+class Sink(object):
+	"""Write-only file the Arrow and Parquet writers write to, emptied after every batch."""
+
+	closed = False
+
+	def __init__(self):
+		self.parts = []
+		self.position = 0
+
+	def write(self, data):
+		data = bytes(data)
+		self.parts.append(data)
+		self.position += len(data)
+		return len(data)
+
+	def tell(self):
+		return self.position
+
+	def flush(self):
+		pass
+
+	def close(self):
+		self.closed = True
+
+	def take(self):
+		data = b''.join(self.parts)
+		self.parts = []
+		return data
+
+
+class NdjsonEncoder(object):
+	def start(self):
+		return ''
+
+	def batch(self, docs):
+		return ''.join([tweets.dumps(doc) + '\n' for doc in docs])
+
+	def end(self):
+		return ''
+
+
+class ArrowEncoder(object):
+	def __init__(self, columns, export_format):
+		self.columns = columns
+		self.schema = pyarrow.schema([(path, pyarrow.type_for_alias(kind)) for path, kind in columns])
+		self.export_format = export_format
+		self.sink = Sink()
+		self.writer = None
+
+	def start(self):
+		if self.export_format == 'arrow':
+			self.writer = pyarrow.ipc.new_stream(self.sink, self.schema)
+		else:
+			self.writer = pyarrow.parquet.ParquetWriter(self.sink, self.schema)
+		return self.sink.take()
+
+	def batch(self, docs):
+		arrays = [pyarrow.array([column_value(doc, path, kind) for doc in docs], type=self.schema.field(i).type)
+				  for i, (path, kind) in enumerate(self.columns)]
+		table = pyarrow.Table.from_arrays(arrays, schema=self.schema)
+		if self.export_format == 'arrow':
+			self.writer.write_table(table)
+		else:
+			# one row group per batch
+			self.writer.write_table(table, row_group_size=len(docs))
+		return self.sink.take()
+
+	def end(self):
+		self.writer.close()
+		return self.sink.take()
+
+
+def encoder(columns, export_format):
+	if export_format == 'ndjson':
+		return NdjsonEncoder()
+	return ArrowEncoder(columns, export_format)
+
+
+def encode(batches, encoder):
+	"""The encoded export of batches of finished documents, one chunk per batch."""
+	yield encoder.start()
+	for docs in batches:
+		if docs:
+			yield encoder.batch(docs)
+	yield encoder.end()
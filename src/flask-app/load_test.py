@@ -0,0 +1,106 @@
+"""Closed-loop load test for the API, to compare the gevent and asyncio serving modes.
+
+	docker-compose run --rm flask-app python load_test.py http://flask-app:8080 --label gevent
+	docker-compose -f docker-compose.yml -f docker-compose.async.yml up -d flask-app
+	docker-compose run --rm flask-app python load_test.py http://flask-app:8080 --label asyncio
+
+Each of --concurrency clients requests the --path endpoints in turn for --duration seconds and
+waits for every response before sending the next request. Requests/sec and latency percentiles
+are printed and saved under --label in --results, together with the earlier runs there, so the
+last command prints both modes side by side. /new/* only return records that were not
+acknowledged and the test sends no acks, so repeated runs read the same pages."""
+import argparse
+import asyncio
+import json
+import os
+import time
+import aiohttp
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def percentile(sorted_values, p):
+	if not sorted_values:
+		return None
+	return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))]
+
+
+async def warm_up(session, url):
+	async with session.get(url) as response:
+		await response.read()
+
+
+async def client(session, urls, deadline, latencies, errors):
+	i = 0
+	while time.perf_counter() < deadline:
+		url = urls[i % len(urls)]
+		i += 1
+		t0 = time.perf_counter()
+		try:
+			async with session.get(url) as response:
+				await response.read()
+				ok = response.status == 200
+		except (aiohttp.ClientError, asyncio.TimeoutError):
+			ok = False
+		if ok:
+			latencies.append(time.perf_counter() - t0)
+		else:
+			errors.append(url)
+
+
+async def run(args):
+	urls = [args.url.rstrip('/') + path for path in args.path]
+	latencies, errors = [], []
+	connector = aiohttp.TCPConnector(limit=args.concurrency)
+	timeout = aiohttp.ClientTimeout(total=args.timeout)
+	async with aiohttp.ClientSession(connector=connector, timeout=timeout,
+									 auth=aiohttp.BasicAuth(args.user, args.password)) as session:
+		# one request per endpoint first, so the cold first request to each is not measured
+		await asyncio.gather(*[warm_up(session, url) for url in urls])
+		start = time.perf_counter()
+		deadline = start + args.duration
+		await asyncio.gather(*[client(session, urls[i % len(urls):] + urls[:i % len(urls)], deadline, latencies, errors)
+							   for i in range(args.concurrency)])
+		elapsed = time.perf_counter() - start
+	latencies.sort()
+	result = {'requests': len(latencies), 'errors': len(errors), 'secs': elapsed,
+			  'requests_per_sec': len(latencies) / elapsed, 'concurrency': args.concurrency, 'paths': args.path}
+	for p in PERCENTILES:
+		result['p%s_ms' % p] = 1000 * percentile(latencies, p) if latencies else None
+	return result
+
+
+def print_table(results):
+	columns = ['requests_per_sec'] + ['p%s_ms' % p for p in PERCENTILES] + ['errors']
+	print('%-12s' % 'mode' + ''.join('%14s' % c for c in columns))
+	for label, result in results.items():
+		print('%-12s' % label + ''.join('%14.1f' % result[c] if result[c] is not None else '%14s' % '-' for c in columns))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('url', help='base url of the API, e.g. http://localhost:8080')
+	parser.add_argument('--path', action='append', help='endpoint to request (repeatable), /new/tweets by default')
+	parser.add_argument('--label', required=True, help='name of the serving mode under test')
+	parser.add_argument('--concurrency', type=int, default=50)
+	parser.add_argument('--duration', type=float, default=30)
+	parser.add_argument('--timeout', type=float, default=30)
+	parser.add_argument('--user', default='user')
+	parser.add_argument('--password', default='user')
+	parser.add_argument('--results', default='load_test_results.json')
+	args = parser.parse_args()
+	args.path = args.path or ['/new/tweets']
+
+	result = asyncio.get_event_loop().run_until_complete(run(args))
+	results = {}
+	if os.path.exists(args.results):
+		with open(args.results) as f:
+			results = json.load(f)
+	results[args.label] = result
+	with open(args.results, 'w') as f:
+		json.dump(results, f, indent=2, sort_keys=True)
+	print_table(results)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,109 @@
+import os
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from pymongo import monitoring
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class Histogram:
+	def __init__(self, buckets=BUCKETS):
+		self.buckets = buckets
+		self.counts = [0] * len(buckets)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		for i, bound in enumerate(self.buckets):
+			if value <= bound:
+				self.counts[i] += 1
+				break
+		self.sum += value
+		self.count += 1
+
+	def snapshot(self):
+		cumulative = 0
+		buckets = {}
+		for bound, count in zip(self.buckets, self.counts):
+			cumulative += count
+			buckets['+Inf' if bound == float('inf') else str(bound)] = cumulative
+		return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+class Registry:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.histograms = defaultdict(Histogram)
+		self.counters = defaultdict(int)
+
+	def observe(self, name, value):
+		with self.lock:
+			self.histograms[name].observe(value)
+
+	def incr(self, name, value=1):
+		with self.lock:
+			self.counters[name] += value
+
+	def snapshot(self):
+		with self.lock:
+			return {'pid': os.getpid(),
+					'histograms': {name: h.snapshot() for name, h in self.histograms.items()},
+					'counters': dict(self.counters)}
+
+
+registry = Registry()
+
+
+class RequestTimer:
+	"""Collects per-stage wall time for one request and reports it when the response is closed.
+
+	Stages of a streamed response interleave, so time is accumulated per stage name and
+	observed once per request rather than once per item."""
+
+	def __init__(self, route):
+		self.route = route
+		self.start = time.perf_counter()
+		self.stages = defaultdict(float)
+
+	@contextmanager
+	def stage(self, name):
+		t0 = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.stages[name] += time.perf_counter() - t0
+
+	def wrap(self, name, fn):
+		def timed(*args, **kwargs):
+			with self.stage(name):
+				return fn(*args, **kwargs)
+		return timed
+
+	def iterate(self, name, iterable):
+		i = iter(iterable)
+		while True:
+			with self.stage(name):
+				try:
+					item = next(i)
+				except StopIteration:
+					return
+			yield item
+
+	def finish(self):
+		registry.observe(f'route.{self.route}', time.perf_counter() - self.start)
+		for name, elapsed in self.stages.items():
+			registry.observe(f'stage.{self.route}.{name}', elapsed)
+
+
+class CommandTimer(monitoring.CommandListener):
+	def started(self, event):
+		pass
+
+	def succeeded(self, event):
+		registry.observe(f'mongo.{event.command_name}', event.duration_micros / 1e6)
+
+	def failed(self, event):
+		registry.observe(f'mongo.{event.command_name}', event.duration_micros / 1e6)
+		registry.incr(f'mongo.{event.command_name}.failed')
@@ -0,0 +1,85 @@
+"""The /new/tweets page: an aggregation pipeline that builds the response shape in the server,
+and the little that is left to do per tweet in Python.
+
+The pipeline renames every field to its response name, including the arrays that the client
+expects as JSON strings (serializedHashtags, serializedSymbols, serializedUrls and serialized_data,
+the related tweets), so mongo:3 cannot produce the final strings itself. finish_tweet turns
+them into strings and flags New York users in one pass over the tweet and its related tweets,
+without copying or deleting keys."""
+import json
+import re
+from bson import json_util
+
+PAGE_SIZE = 100
+NYC = re.compile('Brooklyn|Hoboken|NY|Manhattan|New York|Bronx|Queens|Long Island|Staten Island')
+SERIALIZED_FIELDS = ('serializedHashtags', 'serializedSymbols', 'serializedUrls')
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S:%L"
+
+QUERY = {"acknowledged" : { "$exists" : False }, "classification" : { "$exists" : True },
+		'timelineExpansionAttemptedDate': { "$exists" : True }, 'conversationTrackingAttemptedDate': { "$exists" : True } }
+
+
+# json_util.dumps without its up-front copy of the object (BSON types are converted only when met)
+# and without building a new encoder on every call
+dumps = json.JSONEncoder(default=json_util.default).encode
+
+
+def user_mention():
+	return {
+		'id':'$$mention.id_str',
+		'name': '$$mention.name',
+		'location':None,
+		'screenName':'$$mention.screen_name',
+		'is_nyc':None
+	}
+
+
+def project_tweet(top=""):
+	return {
+		'id':f'${top}id_str',
+		'createdDate':f'${top}created_at',
+		'text':f'${top}full_text',
+		'source':f'${top}tweet_source',
+		'lattitude': { "$arrayElemAt": [ f"${top}coordinates.coordinates", 1 ]},
+		'longitude': { "$arrayElemAt": [ f"${top}coordinates.coordinates", 0 ]},
+		'serializedHashtags' :{"$map":{ "input":f'${top}entities.hashtags', "as": "hashtag","in": "$$hashtag.text" }},
+		'serializedSymbols': {"$map":{ "input":f'${top}entities.symbols', "as": "symbol","in": "$$symbol.text" }},
+		'serializedUrls': {"$map":{ "input":f'${top}entities.urls', "as": "url","in": "$$url.expanded_url" }},
+		'user':{'id': f'${top}user.id_str','name': f'${top}user.name','screenName':f'${top}user.screen_name',
+				'location':f'${top}user.location'},
+		'inReplytoTweetId':f'${top}in_reply_to_status_id_str',
+		'userMentions': { "$map": { "input": f'${top}entities.user_mentions', "as": "mention", "in": user_mention()}},
+	}
+
+
+def projection():
+	return {**project_tweet(), **{'serializedFoursquareCheckin':None,
+			'foursquareCheckinAttemptedDate':None,
+			'timelineExpansionAttemptedDate':{ "$dateToString": { "format":DATE_FORMAT, "date": "$timelineExpansionAttemptedDate" } },
+			'conversationTrackingAttemptedDate':{ "$dateToString": { "format":DATE_FORMAT, "date": "$conversationTrackingAttemptedDate" } },
+			'classification':1,
+			'serialized_data': {"$map": {"input": "$relatedTweets", "as": "tweet", "in": project_tweet("$tweet.") }},
+			'_id':0}}
+
+
+def pipeline(limit=PAGE_SIZE):
+	# limit before projecting, so only the tweets on the page are reshaped
+	return [{"$match": QUERY}, {"$limit": limit}, {"$project": projection()}]
+
+
+def is_nyc(location):
+	return location is not None and NYC.search(location) is not None
+
+
+def finish_related(tweet):
+	tweet['user']['is_nyc'] = is_nyc(tweet['user'].get('location'))
+	for field in SERIALIZED_FIELDS:
+		tweet[field] = dumps(tweet[field])
+	return tweet
+
+
+def finish_tweet(tweet):
+	"""Complete a tweet from the pipeline in place: flag NYC users and serialize the nested lists."""
+	finish_related(tweet)
+	tweet['serialized_data'] = dumps([finish_related(x) for x in tweet['serialized_data'] or ()])
+	return tweet
@@ -1,43 +1,62 @@
 import json
-import schedule
-import time
-from pymongo import MongoClient
+from datetime import datetime
+from dbaccess import get_db
+from batching import read_batches
+from checkpoint import Checkpoint, ORDER, combined_stats
+from leases import Worker, prepare
+from events import consume, publish, freshness_secs, freshness_stats
+from forest import accelerate
+from registry import ModelRegistry
+from scorecache import ScoreCache
 from pymongo import UpdateOne
-from itertools import islice
-from sklearn.externals import joblib
 
-twitter_sick_classifier = joblib.load("final_twitter_models/best_lr_sick_silver.pkl")
+twitter_sick_models = ModelRegistry("final_twitter_models", "twitter_sick", "best_lr_sick_silver.pkl", wrap=accelerate)
+score_cache = ScoreCache(get_db())
 
-def make_batches(n, iterable):
-	i = iter(iterable)
-	piece = list(islice(i, n))
-	while piece:
-		yield piece
-		piece = list(islice(i, n))
+# tweets carry their whole user and relatedTweets; scoring only needs the text
+SCORING_FIELDS = {"full_text": 1, "collected_at": 1}
 
-
-
-def getTweets(db):
-	return db.tweets.find({"classification" : { "$exists" : False }})
+def getTweets(db, checkpoint, bucket, batch):
+	query = checkpoint.query({"bucket": bucket, "classification" : { "$exists" : False }})
+	return read_batches(db.tweets, query, SCORING_FIELDS, batch, sort=ORDER)
 
 def classify(batch =10000):
-	client = MongoClient('mongodb://mongo:27017/')   
-	db = client.fdbnyc
-	tweets = getTweets(db)
-	for batch in make_batches(batch, tweets):
+	db = get_db()
+	prepare(db.tweets)
+	worker = Worker(db, "twitter-classify")
+	freshness=[]
+	checkpoints=[classify_bucket(db, worker, bucket, batch, freshness) for bucket in worker.buckets()]
+	publish(db, 'twitter.classified', freshness=freshness_stats([x for x in freshness if x is not None]),
+			score_cache=score_cache.snapshot(), throughput=combined_stats(checkpoints), worker=worker.owner)
+
+def classify_bucket(db, worker, bucket, batch, freshness):
+	checkpoint = Checkpoint(db, "twitter-classify:%d" % bucket)
+	for batch in getTweets(db, checkpoint, bucket, batch):
 		texts = [ x["full_text"] for x in batch]
-		sick_preds_pos_probs = twitter_sick_classifier.predict_proba(texts)[:,1] 
+		# switch models only between batches, and hold on to this batch's model
+		twitter_sick_models.refresh()
+		sick_model = twitter_sick_models.active
+		sick_preds_pos_probs = score_cache.score(sick_model.version, sick_model.model, texts)
+		canary_scores = twitter_sick_models.score_canary(texts)
 		tweet_requests=[]
+		now = datetime.utcnow()
 		for i, tweet in enumerate(batch):
 			sick_score=sick_preds_pos_probs[i]
-			classification ={ "total_score":sick_score }
-			update = {"$set": {"classification" : classification }}
+			classification ={ "total_score":sick_score, "model_version": {"sick": sick_model.version} }
+			if i in canary_scores:
+				classification["canary"] = {"sick": {"version": twitter_sick_models.canary.version, "score": canary_scores[i]}}
+			update = {"$set": {"classification" : classification, "classified_at": now,
+							   "freshness_secs": freshness_secs(tweet, "collected_at", now) }}
 			tweet_requests.append(UpdateOne({"_id": tweet["_id"]}, update ))
+			freshness.append(update["$set"]["freshness_secs"])
+		if not worker.renew(bucket):
+			# the lease expired and another worker resumed this bucket from the last checkpoint
+			return checkpoint
 		db.tweets.bulk_write(tweet_requests,ordered=False)
+		checkpoint.advance(batch)
+	checkpoint.finish()
+	return checkpoint
 
 
 if __name__ == '__main__':
-	schedule.every().hour.do(classify)
-	while True:
-		schedule.run_pending()
-		time.sleep(1)
+	consume(get_db(), ['twitter.collected'], classify, fallback_secs=3600)
@@ -1,8 +1,9 @@
 from twython import Twython
-from pymongo import MongoClient
+from dbaccess import get_db
 from run_queries import run_queries
 from expand_user_timelines import expand_user_timelines
 from expand_user_conversations import expand_user_conversations
+from inline_classify import load_scorer
 import configparser
 import threading
 import logging
@@ -17,6 +18,11 @@ def search_config():
 	return {'app_key': twitter_config['consumer_key'],
 			'app_secret': twitter_config['consumer_secret']}
 
+def classify_config():
+	config=configparser.ConfigParser()
+	config.read('twitter.ini')
+	return config['CLASSIFY'] if config.has_section('CLASSIFY') else None
+
 def getTwitterToken(config):
 	config=search_config()
 	return Twython(**config, oauth_version=2).obtain_access_token()
@@ -34,8 +40,8 @@ if __name__ == '__main__':
 	config = search_config()
 	token = getTwitterToken(config)
 	queries = ['#foodpoisoning','#stomachache','"food poison"','"food poisoning"','stomach','vomit','puke','diarrhea','"the runs"']
-	client = MongoClient('mongodb://mongo:27017/')
-	db = client.fdbnyc
-	threading.Thread(target=run_queries,args=(getTwitter(config, token), queries, db)).start()
+	db = get_db()
+	scorer = load_scorer(classify_config(), db)
+	threading.Thread(target=run_queries,args=(getTwitter(config, token), queries, db, scorer)).start()
 	threading.Thread(target=expand_user_timelines,args=(getTwitter(config, token), db)).start()
 	threading.Thread(target=expand_user_conversations,args=(getTwitter(config, token), db)).start()
@@ -0,0 +1,68 @@
+import os
+from datetime import datetime
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TweetScorer:
+	def __init__(self, db, model_path, batch_size):
+		# sklearn is only needed when inline scoring is switched on
+		from scorecache import ScoreCache
+		self.score_cache = ScoreCache(db)
+		self.model_path = model_path
+		self.batch_size = batch_size
+		self.models = None
+		self.failed_mtime = None
+		self.load()
+
+	def load(self):
+		"""Load the model, unless the same file already failed to load. True if a model is loaded."""
+		from forest import accelerate
+		from registry import ModelRegistry
+		try:
+			mtime = os.path.getmtime(self.model_path)
+		except OSError:
+			mtime = None
+		if mtime is not None and mtime == self.failed_mtime:
+			return False
+		try:
+			self.models = ModelRegistry(os.path.dirname(self.model_path), 'twitter_sick', os.path.basename(self.model_path),
+										wrap=accelerate)
+		except Exception:
+			self.failed_mtime = mtime
+			logger.error(f'Could not load {self.model_path} for inline scoring', exc_info=True)
+			return False
+		logger.info(f'Scoring tweets inline with {self.models.active.version}')
+		return True
+
+	def score(self, tweets):
+		if self.models is None and not self.load():
+			# raised on every search until the file is replaced with one that loads
+			raise RuntimeError(f'Inline scoring is on but {self.model_path} is not loaded, '
+							   f'{len(tweets)} tweets are left for twitter-classify')
+		self.models.refresh()
+		sick_model = self.models.active
+		for start in range(0, len(tweets), self.batch_size):
+			batch = tweets[start:start+self.batch_size]
+			texts = [x['full_text'] for x in batch]
+			# the same cache as twitter-classify, so either one reuses the other's scores
+			sick_preds_pos_probs = self.score_cache.score(sick_model.version, sick_model.model, texts)
+			canary_scores = self.models.score_canary(texts)
+			now = datetime.utcnow()
+			for i, (tweet, sick_score) in enumerate(zip(batch, sick_preds_pos_probs)):
+				classification = {'total_score': sick_score, 'model_version': {'sick': sick_model.version}}
+				if i in canary_scores:
+					classification['canary'] = {'sick': {'version': self.models.canary.version, 'score': canary_scores[i]}}
+				tweet['classification'] = classification
+				tweet['classified_at'] = now
+				tweet['freshness_secs'] = 0.0
+		return tweets
+
+
+def load_scorer(config, db):
+	if not config or not config.getboolean('inline', fallback=False):
+		return None
+	model_path = config.get('model', fallback='final_twitter_models/best_lr_sick_silver.pkl')
+	return TweetScorer(db, model_path, config.getint('batch_size', fallback=500))
@@ -1,5 +1,8 @@
 from time import sleep
+from datetime import datetime
 from pymongo import UpdateOne
+from events import publish
+from leases import bucket_of
 
 import logging
 
@@ -26,7 +29,19 @@ def search(twitter_api, query, since_id):
 	return query_result
 
 
-def run_queries(twitter_api, queries, db):
+def score_tweets(scorer, tweets):
+	try:
+		scorer.score(tweets)
+	except Exception as e:
+		# unscored tweets are picked up by twitter-classify
+		logger.error('Exception while scoring tweets inline', exc_info=True)
+		for tweet in tweets:
+			tweet.pop('classification', None)
+			tweet.pop('classified_at', None)
+			tweet.pop('freshness_secs', None)
+
+
+def run_queries(twitter_api, queries, db, scorer=None):
 	def rename_id(obj):
 		obj["_id"]=obj["id"]
 		del obj["id"]
@@ -43,10 +58,15 @@ def run_queries(twitter_api, queries, db):
 				since_id = max_query_id['max_id'] if max_query_id else -1
 				tweets = [add_source(rename_id(x)) for x in  search(twitter_api, query, since_id) if 'retweeted_status' not in x]
 				if tweets:
-					twitter_upserts=[UpdateOne({'_id':tweet['_id']}, {"$set": tweet},upsert=True) for tweet in tweets]
-					db.tweets.bulk_write(twitter_upserts,ordered=False)
+					if scorer:
+						score_tweets(scorer, tweets)
+					now = datetime.utcnow()
+					twitter_upserts=[UpdateOne({'_id':tweet['_id']}, {"$set": tweet, "$setOnInsert": {'collected_at': now, 'bucket': bucket_of(tweet['_id'])}},upsert=True) for tweet in tweets]
+					result = db.tweets.bulk_write(twitter_upserts,ordered=False)
+					if result.upserted_count and not all('classification' in tweet for tweet in tweets):
+						publish(db, 'twitter.collected', query=query, tweets=result.upserted_count)
 					new_max_id={ 'max_id': tweets[0]['_id']}
 					db.query_max_id.update_one({'_id': query},{"$set":new_max_id}, upsert=True)
 			except Exception as e:
 				logger.warning(f'Exception while running query {query}', exc_info=True)
-				sleep(60)
\ No newline at end of file
+				sleep(60)
\ No newline at end of file
@@ -1,50 +1,83 @@
 import json
-import schedule
-import time
-from pymongo import MongoClient
+from datetime import datetime
+from dbaccess import get_db
+from batching import read_batches
+from checkpoint import Checkpoint, ORDER, combined_stats
+from leases import Worker, prepare
+from events import consume, publish, freshness_secs, freshness_stats
+from forest import accelerate
+from registry import ModelRegistry
+from scorecache import ScoreCache
 from pymongo import UpdateOne
-from itertools import islice
-from sklearn.externals import joblib
 
-yelp_sick_classifier = joblib.load("final_yelp_models/final_yelp_sick_model.gz")
-yelp_mult_classifier = joblib.load("final_yelp_models/final_yelp_mult_model.gz")
+yelp_sick_models = ModelRegistry("final_yelp_models", "yelp_sick", "final_yelp_sick_model.gz", wrap=accelerate)
+yelp_mult_models = ModelRegistry("final_yelp_models", "yelp_mult", "final_yelp_mult_model.gz", wrap=accelerate)
+score_cache = ScoreCache(get_db())
 
-def make_batches(n, iterable):
-	i = iter(iterable)
-	piece = list(islice(i, n))
-	while piece:
-		yield piece
-		piece = list(islice(i, n))
+# only what scoring and the pending bookkeeping need; the API reads the rest of a review from reviews
+SCORING_FIELDS = {"text": 1, "business_id": 1, "ingested_at": 1}
 
-
-
-def getreviews(db):
-	return db.reviews.find({"classification" : { "$exists" : False }})
+def getreviews(db, checkpoint, bucket, batch):
+	query = checkpoint.query({"bucket": bucket, "classification" : { "$exists" : False }})
+	return read_batches(db.reviews, query, SCORING_FIELDS, batch, sort=ORDER)
 
 def classify(batch =10000):
-	client = MongoClient('mongodb://mongo:27017/')   
-	db = client.fdbnyc
-	reviews = getreviews(db)
-	for batch in make_batches(batch, reviews):
+	db = get_db()
+	prepare(db.reviews)
+	worker = Worker(db, "yelp-classify")
+	freshness=[]
+	checkpoints=[classify_bucket(db, worker, bucket, batch, freshness) for bucket in worker.buckets()]
+	publish(db, 'yelp.classified', freshness=freshness_stats([x for x in freshness if x is not None]),
+			score_cache=score_cache.snapshot(), throughput=combined_stats(checkpoints), worker=worker.owner)
+
+def classify_bucket(db, worker, bucket, batch, freshness):
+	checkpoint = Checkpoint(db, "yelp-classify:%d" % bucket)
+	for batch in getreviews(db, checkpoint, bucket, batch):
 		texts = [ x["text"] for x in batch]
-		sick_preds_pos_probs = yelp_sick_classifier.predict_proba(texts)[:,1] 
-		mult_preds_pos_probs = yelp_mult_classifier.predict_proba(texts)[:,1]
+		# switch models only between batches, and hold on to this batch's models
+		yelp_sick_models.refresh()
+		yelp_mult_models.refresh()
+		sick_model, mult_model = yelp_sick_models.active, yelp_mult_models.active
+		sick_preds_pos_probs = score_cache.score(sick_model.version, sick_model.model, texts)
+		mult_preds_pos_probs = score_cache.score(mult_model.version, mult_model.model, texts)
+		canary_scores = {"sick": yelp_sick_models.score_canary(texts), "mult": yelp_mult_models.score_canary(texts)}
+		canary_versions = {"sick": yelp_sick_models.canary, "mult": yelp_mult_models.canary}
 		review_requests=[]
 		feed_requests=[]
+		pending_review_ids={}
+		now = datetime.utcnow()
 		for i, review in enumerate(batch):
 			sick_score=sick_preds_pos_probs[i]
 			mult_score=mult_preds_pos_probs[i] if sick_score>=0.5 else 0
-			review["classification"] ={ "total_score":(sick_score+mult_score)/2 }
-			update = {"$set": {"classification" : review["classification"]}}
-			update_feed = {"$set": review}
+			classification ={ "total_score":(sick_score+mult_score)/2,
+							  "model_version": {"sick": sick_model.version, "mult": mult_model.version} }
+			canary = {name: {"version": canary_versions[name].version, "score": scores[i]}
+					  for name, scores in canary_scores.items() if i in scores}
+			if canary:
+				classification["canary"] = canary
+			update = {"$set": {"classification" : classification, "classified_at": now,
+							   "freshness_secs": freshness_secs(review, "ingested_at", now)}}
+			freshness.append(update["$set"]["freshness_secs"])
+			update_feed = {"$set": {"business_id": review["business_id"]}}
 			review_requests.append(UpdateOne({"_id": review["_id"]}, update ))
 			feed_requests.append(UpdateOne({"_id": review["_id"]}, update_feed, upsert=True ))
-		db.reviews.bulk_write(review_requests,ordered=False)
+			pending_review_ids.setdefault(review["business_id"], []).append(review["_id"])
+		pending_requests=[UpdateOne({"_id": business_id}, {"$addToSet": {"review_ids": {"$each": review_ids}}}, upsert=True )
+						  for business_id, review_ids in pending_review_ids.items()]
+		if not worker.renew(bucket):
+			# the lease expired and another worker resumed this bucket from the last checkpoint
+			return checkpoint
+		# every write is idempotent and the classification goes last, so a batch cut short
+		# is picked up again by the next run and completed instead of leaving the feed behind;
+		# /new/businesses skips feed entries whose review has no classification yet, so none is
+		# served (and acknowledged) without its score in between
 		db.yelp_feed.bulk_write(feed_requests,ordered=False)
+		db.yelp_pending.bulk_write(pending_requests,ordered=False)
+		db.reviews.bulk_write(review_requests,ordered=False)
+		checkpoint.advance(batch)
+	checkpoint.finish()
+	return checkpoint
 
 
 if __name__ == '__main__':
-	schedule.every().day.at("00:00").do(classify)
-	while True:
-		schedule.run_pending()
-		time.sleep(1)
+	consume(get_db(), ['yelp.ingested'], classify, fallback_secs=24*3600)
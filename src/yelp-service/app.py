@@ -9,7 +9,9 @@ import time
 from datetime import date
 from datetime import datetime
 from datetime import timedelta
-from pymongo import MongoClient
+from dbaccess import get_db
+from events import publish
+from leases import bucket_of
 from pymongo import UpdateOne
 
 config=configparser.ConfigParser()
@@ -68,33 +70,47 @@ def process_business(business):
 	return (reviews, project_id(business))
 
 
+def pending_requests(db,businesses):
+	ids=[business['_id'] for business in businesses]
+	acknowledged={x['_id']:x.get('acknowledged') for x in db.businesses.find({'_id':{'$in':ids}},{'acknowledged':1})}
+	return [UpdateOne({'_id':business['_id']}, {"$set":{'time_updated':business['time_updated']},"$setOnInsert":{'review_ids':[]}},upsert=True)
+			for business in businesses if acknowledged.get(business['_id'])!=business.get('time_updated')]
+
+def write_businesses(db,businesses):
+	pending=pending_requests(db,businesses)
+	db.businesses.bulk_write([UpdateOne({'_id':business['_id']}, {"$set":business},upsert=True) for business in businesses],ordered=False)
+	if pending:
+		db.yelp_pending.bulk_write(pending,ordered=False)
+
 def upsertyelp(db,filename):
 	with gzip.open(filename,'rb') as f:
-		business_requests = []
+		businesses = []
 		review_requests = []
+		now = datetime.utcnow()
 		for number,line in enumerate(f):
 			(reviews,business)=process_business(json.loads(line))
-			business_requests.append(UpdateOne({'_id':business['_id']}, {"$set":business},upsert=True))
-			review_requests.extend([ UpdateOne({'_id':review['_id']}, {"$set": review},upsert=True) for review in reviews])
-			if len(business_requests)>10000:
-				db.businesses.bulk_write(business_requests,ordered=False)
-				business_requests=[]
+			businesses.append(business)
+			review_requests.extend([ UpdateOne({'_id':review['_id']}, {"$set": review, "$setOnInsert": {'ingested_at': now, 'bucket': bucket_of(review['_id'])}},upsert=True) for review in reviews])
+			if len(businesses)>10000:
+				write_businesses(db,businesses)
+				businesses=[]
 			if len(review_requests)>10000:
 				db.reviews.bulk_write(review_requests,ordered=False)
 				review_requests=[]
-		db.businesses.bulk_write(business_requests,ordered=False)
+		if businesses:
+			write_businesses(db,businesses)
 		db.reviews.bulk_write(review_requests,ordered=False)
 	os.remove(filename) 
 
 def checkyelp():
-	client = MongoClient('mongodb://mongo:27017/')   
-	db = client.fdbnyc
+	db = get_db()
 	feed = getfeedwithtolerance(gettolerance(db))
 	if feed:
 		(day,filename)=feed
 		withtime=datetime.combine(day, datetime.min.time())
 		upsertyelp(db,filename)
-		db.yelp_history.insert_one({"date": withtime})    
+		db.yelp_history.insert_one({"date": withtime})
+		publish(db, 'yelp.ingested', date=withtime)    
 
 
 if __name__ == '__main__':